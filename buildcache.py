@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import shlex
+import time
+
+from twisted.internet import defer
+from twisted.python import log
+from buildbot.process import buildstep
+from buildbot.process.results import SUCCESS, WARNINGS
+
+# Index and output archives of the build cache. Like the git mirrors, this
+# lives on the host shared by the master and the worker.
+CACHE_ROOT = '/tmp/buildbot-build-cache'
+DEFAULT_MAX_AGE_DAYS = 14
+DEFAULT_MAX_ENTRIES = 500
+
+
+def cache_key(tree_hash, target, properties):
+    """The cache key for running `target` on a git tree with the given properties."""
+    blob = json.dumps([tree_hash, target, sorted(properties.items())])
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+@defer.inlineCallbacks
+def run_on_worker(step, command, log_name, collectStdout=False):
+    """Runs `command` for `step` on its worker, logged as `log_name`; returns the command."""
+    cmd = yield step.makeRemoteShellCommand(command=command, stdioLogName=log_name,
+                                            collectStdout=collectStdout)
+    yield step.runCommand(cmd)
+    return cmd
+
+
+class LocalBuildCache:
+    """
+    A build result cache on the local disk: a JSON index of key -> result
+    and source build, plus a tar archive of the step's outputs per key.
+    Subclasses may index other files and prune them by their own policy.
+    """
+
+    def __init__(self, root=CACHE_ROOT, max_age_days=DEFAULT_MAX_AGE_DAYS,
+                 max_entries=DEFAULT_MAX_ENTRIES):
+        self.root = root
+        self.max_age = max_age_days * 24 * 3600
+        self.max_entries = max_entries
+
+    def archive_path(self, key):
+        return os.path.join(self.root, key + '.tar')
+
+    def _index_path(self, name='index'):
+        return os.path.join(self.root, name + '.json')
+
+    def _load(self, name='index'):
+        try:
+            with open(self._index_path(name), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, index, name='index'):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self._index_path(name) + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, self._index_path(name))
+
+    def lookup(self, key):
+        entry = self._load().get(key)
+        if entry is None or time.time() - entry['created'] > self.max_age:
+            return None
+        if entry['outputs'] and not os.path.exists(self.archive_path(key)):
+            return None
+        return entry
+
+    def store(self, key, entry):
+        index = self._load()
+        index[key] = entry
+        self._prune(index)
+        self._save(index)
+
+    def _prune(self, index):
+        now = time.time()
+        expired = [k for k, e in index.items() if now - e['created'] > self.max_age]
+        by_age = sorted((k for k in index if k not in expired), key=lambda k: index[k]['created'])
+        expired += by_age[:max(0, len(by_age) - self.max_entries)]
+        self._remove(index, expired)
+
+    def _remove(self, index, keys):
+        for k in keys:
+            del index[k]
+            try:
+                os.remove(self.archive_path(k))
+            except OSError:
+                pass
+        if keys:
+            log.msg('buildcache: pruned {} entries from {}'.format(len(keys), self.root))
+
+
+class CachedShellCommand(buildstep.ShellMixin, buildstep.BuildStep):
+    """
+    A ShellCommand whose result is cached on the build's `tree_hash`
+    property, the cache target name and the values of key_properties.
+
+    On a hit the command is not run: the stored `outputs` (paths relative to
+    the workdir) are unpacked into the workdir and the cached result is
+    returned, with a link to the build that produced it. On a successful
+    miss the outputs are archived and the result recorded.
+    """
+
+    def __init__(self, cache, cache_target, outputs=None, key_properties=None, **kwargs):
+        self.cache = cache
+        self.cache_target = cache_target
+        self.outputs = outputs or []
+        self.key_properties = key_properties or []
+        kwargs = self.setupShellMixin(kwargs)
+        super().__init__(**kwargs)
+
+    def _cache_key(self):
+        tree_hash = self.getProperty('tree_hash')
+        if not tree_hash:
+            return None
+        properties = {p: self.getProperty(p) for p in self.key_properties}
+        return cache_key(tree_hash, self.cache_target, properties)
+
+    @defer.inlineCallbacks
+    def run(self):
+        key = self._cache_key()
+        entry = self.cache.lookup(key) if key else None
+        if entry is not None:
+            restored = True
+            if entry['outputs']:
+                cmd = yield run_on_worker(self, ['tar', '-xf', self.cache.archive_path(key)], 'cache')
+                restored = not cmd.didFail()
+            if restored:
+                source = '{} #{}'.format(entry['builder'], entry['number'])
+                self.descriptionDone = '{} cached from {}'.format(self.cache_target, source)
+                self.setProperty(self.cache_target + '_cached_from', source, 'CachedShellCommand')
+                yield self.addURL('cached from ' + source, entry['url'])
+                return entry['results']
+
+        cmd = yield self.makeRemoteShellCommand()
+        yield self.runCommand(cmd)
+        results = cmd.results()
+
+        if key is not None and results in (SUCCESS, WARNINGS):
+            stored = True
+            if self.outputs:
+                archive = self.cache.archive_path(key)
+                os.makedirs(self.cache.root, exist_ok=True)
+                cmd = yield run_on_worker(
+                    self, 'tar -cf {tmp} {outputs} && mv {tmp} {archive}'.format(
+                        tmp=shlex.quote(archive + '.tmp'), archive=shlex.quote(archive),
+                        outputs=' '.join(shlex.quote(o) for o in self.outputs)), 'cache')
+                stored = not cmd.didFail()
+            if stored:
+                url = yield self.build.getUrl()
+                self.cache.store(key, {
+                    'results': results,
+                    'outputs': self.outputs,
+                    'builder': self.build.builder.name,
+                    'number': self.build.number,
+                    'url': url,
+                    'created': time.time(),
+                })
+        return results
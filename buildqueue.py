@@ -0,0 +1,103 @@
+import time
+
+from twisted.internet import defer
+
+# A request for these realms is treated as if it had already waited this
+# many more seconds. Realms not listed get no head start.
+DEFAULT_REALM_HEAD_START = {'prod': 1800}
+
+# Starvation guard: a request that waited this long goes ahead of every
+# request that did not, whatever their realms, oldest first.
+MAX_WAIT_SECONDS = 3600
+
+# Seconds of waiting a request loses per second its builder usually takes,
+# so that among equals the quick builds go first.
+DURATION_WEIGHT = 0.25
+
+# Builders' usual durations are the mean of their last ESTIMATE_HISTORY
+# builds, looked up again at most every ESTIMATE_TTL_SECONDS.
+ESTIMATE_HISTORY = 10
+ESTIMATE_TTL_SECONDS = 600
+
+
+def request_score(head_start, waited, estimate):
+    """Higher goes first. Starved requests sort above all others."""
+    if waited >= MAX_WAIT_SECONDS:
+        return (True, waited)
+    return (False, head_start + waited - DURATION_WEIGHT * estimate)
+
+
+class BuildPrioritizer:
+    """
+    Orders both the builders (c['prioritizeBuilders']) and the requests of
+    each builder (BuilderConfig nextBuild) by request_score, using the realm
+    of the request's branch, or failing that a realm among the builder's
+    tags.
+    """
+
+    def __init__(self, realm_head_start, branch_realms):
+        self.realm_head_start = realm_head_start
+        self.branch_realms = branch_realms
+        self._estimates = {}
+        self._branches = {}
+
+    def _realm(self, branch, tags):
+        if branch in self.branch_realms:
+            return self.branch_realms[branch]
+        return next((t for t in tags if t in self.realm_head_start), None)
+
+    @defer.inlineCallbacks
+    def _estimate(self, master, builderid):
+        fetched = self._estimates.get(builderid)
+        if fetched is not None and time.time() - fetched[0] < ESTIMATE_TTL_SECONDS:
+            return fetched[1]
+        builds = yield master.data.get(('builders', builderid, 'builds'),
+                                       order=['-number'], limit=ESTIMATE_HISTORY)
+        durations = [(b['complete_at'] - b['started_at']).total_seconds()
+                     for b in builds if b['complete_at']]
+        estimate = sum(durations) / len(durations) if durations else 0
+        self._estimates[builderid] = (time.time(), estimate)
+        return estimate
+
+    @defer.inlineCallbacks
+    def _branch(self, master, bsid):
+        if bsid not in self._branches:
+            if len(self._branches) > 1000:
+                self._branches.clear()
+            buildset = yield master.data.get(('buildsets', bsid))
+            sourcestamps = buildset['sourcestamps'] if buildset else []
+            self._branches[bsid] = sourcestamps[0]['branch'] if sourcestamps else None
+        return self._branches[bsid]
+
+    @defer.inlineCallbacks
+    def _score(self, master, builder, builderid, bsid, submitted_at):
+        branch = yield self._branch(master, bsid)
+        estimate = yield self._estimate(master, builderid)
+        realm = self._realm(branch, builder.config.tags or [])
+        return request_score(self.realm_head_start.get(realm, 0),
+                             time.time() - submitted_at, estimate)
+
+    @defer.inlineCallbacks
+    def prioritizeBuilders(self, master, builders):
+        scores = {}
+        for builder in builders:
+            builderid = yield builder.getBuilderId()
+            requests = yield master.db.buildrequests.getBuildRequests(
+                builderid=builderid, claimed=False, complete=False)
+            best = (False, float('-inf'))
+            for br in requests:
+                score = yield self._score(master, builder, builderid, br['buildsetid'],
+                                          br['submitted_at'].timestamp())
+                best = max(best, score)
+            scores[builder.name] = best
+        return sorted(builders, key=lambda b: scores[b.name], reverse=True)
+
+    @defer.inlineCallbacks
+    def nextBuild(self, builder, requests):
+        builderid = yield builder.getBuilderId()
+        best, best_score = None, None
+        for br in requests:
+            score = yield self._score(builder.master, builder, builderid, br.bsid, br.submittedAt)
+            if best_score is None or score > best_score:
+                best, best_score = br, score
+        return best
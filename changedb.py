@@ -0,0 +1,171 @@
+import copy
+import json
+
+import sqlalchemy as sa
+from twisted.internet import defer
+from twisted.python import log
+from buildbot.process import metrics as bbmetrics
+from buildbot.process.users import users
+
+import metrics
+
+
+def _fill_change_defaults(master, change):
+    """
+    Apply the same defaulting as the data API's addChange: Change-sourced
+    properties, the configured revlink and the codebase.
+    """
+    change = dict(change)
+    properties = change.get('properties') or {}
+    change['properties'] = {k: (v, 'Change') for k, v in properties.items()}
+    change.setdefault('repository', '')
+    change.setdefault('project', '')
+
+    revlink = change.get('revlink') or ''
+    if not revlink and change.get('revision') and change['repository'] \
+            and callable(master.config.revlink):
+        revlink = master.config.revlink(change['revision'], change['repository']) or ''
+    change['revlink'] = revlink
+
+    if change.get('codebase') is None and master.config.codebaseGenerator is not None:
+        pre_change = master.config.preChangeGenerator(**change)
+        change['codebase'] = str(master.config.codebaseGenerator(pre_change))
+    else:
+        change['codebase'] = change.get('codebase') or ''
+
+    if change.get('when_timestamp') is None:
+        change['when_timestamp'] = master.reactor.seconds()
+    return change
+
+
+@defer.inlineCallbacks
+def add_changes(master, changes):
+    """
+    Add a batch of changes to the database in a single transaction.
+
+    `changes` is a list of dicts taking the same arguments as
+    master.data.updates.addChange, oldest first. The `changes/new` events
+    the schedulers listen for are only produced once the whole batch has
+    been committed, in the same order. Returns the new changeids.
+    """
+    if not changes:
+        return []
+
+    bbmetrics.MetricCountEvent.log("added_changes", len(changes))
+    changes = [_fill_change_defaults(master, ch) for ch in changes]
+
+    # one user object per distinct author, rather than one per change
+    uids = {}
+    for ch in changes:
+        key = (ch['author'], ch.get('src'))
+        if key not in uids:
+            uids[key] = None
+            if ch.get('src'):
+                uids[key] = yield users.createUserObject(master, ch['author'], ch['src'])
+
+    db = master.db
+    model = db.model
+    ch_tbl = model.changes
+    ss_tbl = model.sourcestamps
+    for ch in changes:
+        for column in ('author', 'committer', 'branch', 'revision', 'revlink',
+                       'category', 'repository', 'project'):
+            db.changes.checkLength(getattr(ch_tbl.c, column), ch.get(column))
+        for f in ch.get('files') or []:
+            db.changes.checkLength(model.change_files.c.filename, f)
+        for k in ch['properties']:
+            db.changes.checkLength(model.change_properties.c.property_name, k)
+    created_at = int(master.reactor.seconds())
+
+    def thd(conn):
+        transaction = conn.begin()
+        if conn.dialect.name == 'sqlite':
+            # pysqlite only sends BEGIN ahead of the first INSERT, which
+            # would leave a SAVEPOINT before it as the outermost transaction
+            conn.execute(sa.text('BEGIN'))
+        # the newest change on each (branch, repository, project, codebase),
+        # so that consecutive changes in the batch chain onto each other
+        parents = {}
+        changeids = []
+        for ch in changes:
+            branch, revision = ch.get('branch'), ch.get('revision')
+            repository, project, codebase = ch['repository'], ch['project'], ch['codebase']
+
+            ss_hash = db.sourcestamps.hashColumns(branch, revision, repository,
+                                                  project, codebase, None)
+            ssid = conn.scalar(sa.select([ss_tbl.c.id], whereclause=ss_tbl.c.ss_hash == ss_hash))
+            if ssid is None:
+                # another writer may insert the same sourcestamp after the
+                # select; only the savepoint is undone when it did
+                savepoint = conn.begin_nested()
+                try:
+                    r = conn.execute(ss_tbl.insert(), dict(
+                        branch=branch, revision=revision, repository=repository,
+                        codebase=codebase, project=project, patchid=None,
+                        ss_hash=ss_hash, created_at=created_at))
+                    savepoint.commit()
+                    ssid = r.inserted_primary_key[0]
+                except sa.exc.IntegrityError:
+                    savepoint.rollback()
+                    ssid = conn.scalar(sa.select(
+                        [ss_tbl.c.id], whereclause=ss_tbl.c.ss_hash == ss_hash))
+
+            parent_key = (branch, repository, project, codebase)
+            if parent_key not in parents:
+                parents[parent_key] = conn.scalar(sa.select(
+                    [ch_tbl.c.changeid],
+                    whereclause=((ch_tbl.c.branch == branch) &
+                                 (ch_tbl.c.repository == repository) &
+                                 (ch_tbl.c.project == project) &
+                                 (ch_tbl.c.codebase == codebase)),
+                    order_by=sa.desc(ch_tbl.c.changeid),
+                    limit=1))
+
+            r = conn.execute(ch_tbl.insert(), dict(
+                author=ch['author'],
+                committer=ch.get('committer'),
+                comments=ch.get('comments'),
+                branch=branch,
+                revision=revision,
+                revlink=ch['revlink'],
+                when_timestamp=ch['when_timestamp'],
+                category=ch.get('category'),
+                repository=repository,
+                codebase=codebase,
+                project=project,
+                sourcestampid=ssid,
+                parent_changeids=parents[parent_key]))
+            changeid = r.inserted_primary_key[0]
+            parents[parent_key] = changeid
+            changeids.append(changeid)
+
+            if ch.get('files'):
+                conn.execute(model.change_files.insert(), [
+                    dict(changeid=changeid, filename=f) for f in ch['files']
+                ])
+            if ch['properties']:
+                conn.execute(model.change_properties.insert(), [
+                    dict(changeid=changeid, property_name=k, property_value=json.dumps(v))
+                    for k, v in ch['properties'].items()
+                ])
+            uid = uids[(ch['author'], ch.get('src'))]
+            if uid:
+                conn.execute(model.change_users.insert(), dict(changeid=changeid, uid=uid))
+
+        transaction.commit()
+        return changeids
+
+    started = master.reactor.seconds()
+    changeids = yield db.pool.do(thd)
+    metrics.observe('buildbot_change_insert_seconds', master.reactor.seconds() - started)
+
+    # announce the changes only now that they are all committed
+    for changeid in changeids:
+        change = yield master.data.get(('changes', str(changeid)))
+        master.data.rtypes.change.produceEvent(copy.deepcopy(change), 'new')
+
+    msg = "added {} changes ({} .. {}) to database".format(
+        len(changes), changes[0].get('revision'), changes[-1].get('revision'))
+    log.msg(msg.encode('utf-8', 'replace'))
+
+    return changeids
@@ -0,0 +1,227 @@
+import os
+import time
+
+import sqlalchemy as sa
+from twisted.internet import defer, task
+from twisted.python import log
+from buildbot.util import service
+
+import metrics
+
+# How long builds and their logs are kept, by builder name, by the realm
+# among the builder's tags, and otherwise. A policy may give either key.
+DEFAULT_RETENTION = {'build_days': 180, 'log_days': 30}
+
+# Changes older than this are pruned, except the newest of each branch.
+CHANGE_RETENTION_DAYS = 180
+
+MAINTENANCE_INTERVAL_SECONDS = 6 * 3600
+
+# Rows are deleted this many builds, logs or changes per transaction, so
+# the writers inserting changes and steps only ever wait for one batch.
+PRUNE_BATCH_SIZE = 50
+
+# Buildbot runs a single DB thread for SQLite, which queues every write
+# behind the longest running web UI query. In WAL mode readers do not block
+# the writer, so `pool_threads` may give a file database more threads. This
+# resizes the pool behind buildbot's back and is off unless configured.
+SQLITE_POOL_THREADS = None
+
+# Set on every new SQLite connection. busy_timeout makes a writer wait for
+# the lock inside SQLite instead of failing into the pool's retry backoff.
+SQLITE_PRAGMAS = (
+    'busy_timeout = 5000',
+    'synchronous = NORMAL',
+    'temp_store = MEMORY',
+    'cache_size = -16000',
+)
+
+
+def retention_for(retention, buildername, tags):
+    """The build_days/log_days policy of a builder."""
+    policy = dict(DEFAULT_RETENTION, **retention.get('default', {}))
+    for tag in tags:
+        policy.update(retention.get('realms', {}).get(tag, {}))
+    policy.update(retention.get('builders', {}).get(buildername, {}))
+    return policy
+
+
+def _delete(conn, table, column, ids):
+    if ids:
+        conn.execute(table.delete(column.in_(ids)))
+
+
+def thd_prune_builds(conn, model, builderid, before, limit):
+    """Deletes up to `limit` builds finished before `before`, with all their rows."""
+    buildids = [r.id for r in conn.execute(
+        sa.select([model.builds.c.id])
+        .where((model.builds.c.builderid == builderid) &
+               (model.builds.c.complete_at < before))
+        .order_by(model.builds.c.id).limit(limit))]
+    if not buildids:
+        return 0
+    with conn.begin():
+        stepids = [r.id for r in conn.execute(
+            sa.select([model.steps.c.id]).where(model.steps.c.buildid.in_(buildids)))]
+        logids = [r.id for r in conn.execute(
+            sa.select([model.logs.c.id]).where(model.logs.c.stepid.in_(stepids)))] \
+            if stepids else []
+        setids = [r.id for r in conn.execute(
+            sa.select([model.test_result_sets.c.id])
+            .where(model.test_result_sets.c.buildid.in_(buildids)))]
+
+        _delete(conn, model.logchunks, model.logchunks.c.logid, logids)
+        _delete(conn, model.logs, model.logs.c.id, logids)
+        _delete(conn, model.test_results, model.test_results.c.test_result_setid, setids)
+        _delete(conn, model.test_result_sets, model.test_result_sets.c.id, setids)
+        _delete(conn, model.steps, model.steps.c.id, stepids)
+        _delete(conn, model.build_properties, model.build_properties.c.buildid, buildids)
+        _delete(conn, model.build_data, model.build_data.c.buildid, buildids)
+        conn.execute(model.buildsets.update()
+                     .where(model.buildsets.c.parent_buildid.in_(buildids))
+                     .values(parent_buildid=None))
+        _delete(conn, model.builds, model.builds.c.id, buildids)
+    return len(buildids)
+
+
+def thd_prune_logs(conn, model, builderid, before, limit):
+    """Empties up to `limit` logs of the builds finished before `before`."""
+    logids = [r.id for r in conn.execute(
+        sa.select([model.logs.c.id])
+        .select_from(model.logs.join(model.steps).join(model.builds))
+        .where((model.builds.c.builderid == builderid) &
+               (model.builds.c.complete_at < before) &
+               (model.logs.c.type != 'd'))
+        .order_by(model.logs.c.id).limit(limit))]
+    if not logids:
+        return 0
+    with conn.begin():
+        conn.execute(model.logs.update().where(model.logs.c.id.in_(logids)).values(type='d'))
+        _delete(conn, model.logchunks, model.logchunks.c.logid, logids)
+    return len(logids)
+
+
+def thd_prune_changes(conn, model, before, limit):
+    """Deletes up to `limit` changes older than `before`, but not the newest of a branch."""
+    changes = model.changes
+    newest = sa.select([sa.func.max(changes.c.changeid)]).group_by(
+        changes.c.repository, changes.c.branch, changes.c.project, changes.c.codebase)
+    changeids = [r.changeid for r in conn.execute(
+        sa.select([changes.c.changeid])
+        .where((changes.c.when_timestamp < before) & changes.c.changeid.notin_(newest))
+        .order_by(changes.c.changeid).limit(limit))]
+    if not changeids:
+        return 0
+    with conn.begin():
+        for table in (model.scheduler_changes, model.change_files,
+                      model.change_properties, model.change_users, changes):
+            _delete(conn, table, table.c.changeid, changeids)
+    return len(changeids)
+
+
+def thd_compact(conn):
+    """
+    Returns the space freed by the prunes to the filesystem and truncates
+    the WAL. The first run switches the database to incremental vacuuming,
+    which takes one full VACUUM.
+    """
+    if conn.execute('pragma auto_vacuum').scalar() != 2:
+        conn.execute('pragma auto_vacuum = incremental')
+        conn.execute('vacuum')
+    else:
+        conn.execute('pragma incremental_vacuum')
+    conn.execute('pragma wal_checkpoint(truncate)').fetchall()
+    conn.execute('pragma optimize')
+
+
+def database_size(path):
+    return sum(os.path.getsize(path + suffix)
+               for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+
+class StateMaintenance(service.BuildbotService):
+    """
+    Keeps the state database small and responsive: prunes builds, logs and
+    changes past their retention in small transactions, compacts SQLite
+    afterwards and lets SQLite readers run alongside the writer.
+    """
+    name = 'state-maintenance'
+
+    def reconfigService(self, retention, interval=MAINTENANCE_INTERVAL_SECONDS,
+                        batch_size=PRUNE_BATCH_SIZE, pool_threads=SQLITE_POOL_THREADS):
+        self.retention = retention
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pool_threads = pool_threads
+        return super().reconfigService(name=self.name)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield super().startService()
+        pool = self.master.db.pool
+        self.sqlite_path = None
+        if pool.engine.dialect.name == 'sqlite' and pool.engine.url.database:
+            self.sqlite_path = pool.engine.url.database
+            sa.event.listen(pool.engine.pool, 'connect', self._set_pragmas)
+            if self.pool_threads:
+                pool._pool.adjustPoolsize(minthreads=1, maxthreads=self.pool_threads)
+                log.msg('dbmaintenance: {} DB threads for {}'.format(
+                    self.pool_threads, self.sqlite_path))
+        self._loop = task.LoopingCall(self.maintain)
+        self._loop.clock = self.master.reactor
+        self._loop.start(self.interval, now=False)
+
+    def stopService(self):
+        if self._loop.running:
+            self._loop.stop()
+        return super().stopService()
+
+    @staticmethod
+    def _set_pragmas(connection, record):
+        for pragma in SQLITE_PRAGMAS:
+            connection.execute('pragma ' + pragma)
+
+    @defer.inlineCallbacks
+    def _batches(self, thd, *args):
+        """Runs `thd` one transaction at a time until it finds nothing left."""
+        total = 0
+        while True:
+            started = time.time()
+            n = yield self.master.db.pool.do(thd, self.master.db.model, *args, self.batch_size)
+            metrics.observe('buildbot_db_batch_seconds', time.time() - started,
+                            operation=thd.__name__[len('thd_'):])
+            total += n
+            if n < self.batch_size:
+                return total
+
+    @defer.inlineCallbacks
+    def maintain(self):
+        try:
+            yield self._maintain()
+        except Exception as e:
+            log.err(e, 'while maintaining the state database')
+
+    @defer.inlineCallbacks
+    def _maintain(self):
+        started = time.time()
+        size = database_size(self.sqlite_path) if self.sqlite_path else None
+        now = self.master.reactor.seconds()
+        pruned = {'builds': 0, 'logs': 0, 'changes': 0}
+
+        builders = yield self.master.data.get(('builders',))
+        for builder in builders:
+            policy = retention_for(self.retention, builder['name'], builder['tags'] or [])
+            pruned['builds'] += yield self._batches(
+                thd_prune_builds, builder['builderid'], now - policy['build_days'] * 86400)
+            pruned['logs'] += yield self._batches(
+                thd_prune_logs, builder['builderid'], now - policy['log_days'] * 86400)
+        change_days = self.retention.get('change_days', CHANGE_RETENTION_DAYS)
+        pruned['changes'] = yield self._batches(thd_prune_changes, now - change_days * 86400)
+
+        summary = ', '.join('{} {}'.format(n, kind) for kind, n in pruned.items())
+        if self.sqlite_path:
+            yield self.master.db.pool.do(thd_compact)
+            summary += '; {} {:.1f} MB -> {:.1f} MB'.format(
+                os.path.basename(self.sqlite_path), size / 1e6,
+                database_size(self.sqlite_path) / 1e6)
+        log.msg('dbmaintenance: pruned {} in {:.1f}s'.format(summary, time.time() - started))
@@ -0,0 +1,116 @@
+import hashlib
+import shlex
+import time
+
+from twisted.internet import defer
+from twisted.python import log
+from buildbot.process import buildstep
+from buildbot.process.results import SUCCESS
+
+import buildcache
+
+# Snapshots of migrated test databases, on the host shared by the master
+# and the worker.
+SNAPSHOT_ROOT = '/tmp/buildbot-db-snapshots'
+
+# Files whose contents decide the migrated schema
+SCHEMA_PATHS = ['db/migrate', 'db/schema.rb']
+
+# How to save a database to a snapshot file and load it back, per adapter.
+# `database` is the file for sqlite3 and the database name otherwise.
+ADAPTERS = {
+    'sqlite3': {
+        'save': 'cp {database} {snapshot}',
+        'restore': 'cp {snapshot} {database}',
+    },
+    'postgresql': {
+        'save': 'pg_dump --format=custom --no-owner --file={snapshot} {database}',
+        'restore': 'dropdb --if-exists {database} && createdb {database} && '
+                   'pg_restore --no-owner --dbname={database} {snapshot}',
+    },
+}
+
+SNAPSHOTS = buildcache.LocalBuildCache(root=SNAPSHOT_ROOT, max_entries=20)
+
+
+class SnapshotMigrate(buildstep.ShellMixin, buildstep.BuildStep):
+    """
+    Migrates the test database, or restores the snapshot taken after
+    migrating the same db/migrate and db/schema.rb. A fresh migration is
+    saved as the new snapshot.
+
+    Sets `db_snapshot_restored`, and `startup_to_first_test_seconds`: the
+    time from the start of the build until the database is ready.
+    """
+
+    def __init__(self, adapter, database, snapshots=SNAPSHOTS, **kwargs):
+        self.adapter = ADAPTERS[adapter]
+        self.adapter_name = adapter
+        self.database = database
+        self.snapshots = snapshots
+        kwargs = self.setupShellMixin(kwargs)
+        super().__init__(**kwargs)
+
+    @defer.inlineCallbacks
+    def _snapshot_key(self):
+        # the checkout is clean, so the blob ids in HEAD are the file contents
+        cmd = yield buildcache.run_on_worker(
+            self, ['git', 'ls-tree', '-r', 'HEAD', '--'] + SCHEMA_PATHS, 'snapshot',
+            collectStdout=True)
+        if cmd.didFail() or not cmd.stdout.strip():
+            return None
+        schema_hash = hashlib.sha256(cmd.stdout.encode('utf-8')).hexdigest()
+        return buildcache.cache_key(schema_hash, 'db-snapshot',
+                                    {'adapter': self.adapter_name, 'database': self.database})
+
+    @defer.inlineCallbacks
+    def _set_ready_time(self):
+        build = yield self.master.data.get(('builds', self.build.buildid))
+        ready = self.master.reactor.seconds() - build['started_at'].timestamp()
+        self.setProperty('startup_to_first_test_seconds', round(ready, 1), 'SnapshotMigrate')
+        log.msg('startup to first test for {}: {:.1f}s'.format(self.build.builder.name, ready))
+
+    @defer.inlineCallbacks
+    def run(self):
+        key = yield self._snapshot_key()
+        entry = self.snapshots.lookup(key) if key else None
+        if entry is not None:
+            cmd = yield buildcache.run_on_worker(self, self.adapter['restore'].format(
+                snapshot=shlex.quote(self.snapshots.archive_path(key)),
+                database=shlex.quote(self.database)), 'snapshot')
+            if not cmd.didFail():
+                self.descriptionDone = 'restored db snapshot from {} #{}'.format(
+                    entry['builder'], entry['number'])
+                self.setProperty('db_snapshot_restored', True, 'SnapshotMigrate')
+                yield self._set_ready_time()
+                return SUCCESS
+
+        cmd = yield self.makeRemoteShellCommand()
+        yield self.runCommand(cmd)
+        results = cmd.results()
+        self.setProperty('db_snapshot_restored', False, 'SnapshotMigrate')
+        if results != SUCCESS:
+            return results
+        yield self._set_ready_time()
+
+        if key is not None:
+            snapshot = self.snapshots.archive_path(key)
+            saved = yield buildcache.run_on_worker(
+                self, 'mkdir -p {root} && tmp=$(mktemp {snapshot}.XXXXXX) && '
+                '{{ {save} && mv "$tmp" {snapshot} || {{ rm -f "$tmp"; false; }}; }}'.format(
+                    root=shlex.quote(self.snapshots.root),
+                    snapshot=shlex.quote(snapshot),
+                    save=self.adapter['save'].format(snapshot='"$tmp"',
+                                                     database=shlex.quote(self.database))),
+                'snapshot')
+            if not saved.didFail():
+                url = yield self.build.getUrl()
+                self.snapshots.store(key, {
+                    'results': results,
+                    'outputs': [self.database],
+                    'builder': self.build.builder.name,
+                    'number': self.build.number,
+                    'url': url,
+                    'created': time.time(),
+                })
+        return results
@@ -0,0 +1,139 @@
+import os
+import shlex
+import time
+
+from twisted.internet import defer
+from buildbot.plugins import util
+from buildbot.process import buildstep
+from buildbot.process.results import SUCCESS
+
+import buildcache
+
+# Archives of installed dependencies, keyed by lockfile hash. Like the build
+# cache, this lives on the host shared by the master and the worker.
+DEPCACHE_ROOT = '/tmp/buildbot-dep-cache'
+DEFAULT_BUDGET_GB = 10
+
+# For Go steps: keep the module cache inside the workdir so that it can be
+# archived, and writable so that the warm workspace can clean it.
+GO_MODULE_ENV = {
+    'GOMODCACHE': util.Interpolate('%(prop:builddir)s/build/.gomodcache'),
+    'GOFLAGS': '-modcacherw',
+}
+
+
+class DependencyCache(buildcache.LocalBuildCache):
+    """
+    Dependency archives on the local disk, evicted least recently used
+    first once their total size goes over the disk budget. Hits and misses
+    are counted next to the index.
+    """
+
+    def __init__(self, root=DEPCACHE_ROOT, budget_gb=DEFAULT_BUDGET_GB):
+        super().__init__(root=root)
+        self.budget = budget_gb * 1024 ** 3
+
+    def lookup(self, key):
+        index = self._load()
+        entry = index.get(key)
+        if entry is None or not os.path.exists(self.archive_path(key)):
+            return None
+        entry['last_used'] = time.time()
+        self._save(index)
+        return entry
+
+    def store(self, key, entry):
+        entry['size'] = os.path.getsize(self.archive_path(key))
+        entry['last_used'] = time.time()
+        super().store(key, entry)
+
+    def counts(self):
+        return dict({'hits': 0, 'misses': 0}, **self._load('counts'))
+
+    def record(self, hit):
+        """Count a hit or miss; returns the hit rate so far."""
+        counts = self.counts()
+        counts['hits' if hit else 'misses'] += 1
+        self._save(counts, 'counts')
+        return counts['hits'] / (counts['hits'] + counts['misses'])
+
+    def _prune(self, index):
+        total = sum(e['size'] for e in index.values())
+        evicted = []
+        for k in sorted(index, key=lambda k: index[k]['last_used']):
+            if total <= self.budget:
+                break
+            total -= index[k]['size']
+            evicted.append(k)
+        self._remove(index, evicted)
+
+
+DEPENDENCY_CACHE = DependencyCache()
+
+
+class CachedDependencies(buildstep.ShellMixin, buildstep.BuildStep):
+    """
+    Runs a dependency install command (bundle install, go mod download)
+    unless its `paths` (relative to the workdir) were already installed for
+    the same `lockfile` contents, in which case they are unpacked from the
+    cache instead. Sets `dependencies_cached` and the cache's
+    `dependency_cache_hit_rate`.
+    """
+    renderables = ['lockfile']
+
+    def __init__(self, lockfile, paths, cache=DEPENDENCY_CACHE, **kwargs):
+        self.lockfile = lockfile
+        self.paths = paths
+        self.cache = cache
+        kwargs = self.setupShellMixin(kwargs)
+        super().__init__(**kwargs)
+
+    @defer.inlineCallbacks
+    def _cache_key(self):
+        cmd = yield buildcache.run_on_worker(self, ['sha256sum', self.lockfile], 'cache',
+                                             collectStdout=True)
+        if cmd.didFail() or not cmd.stdout.strip():
+            return None
+        lockfile_hash = cmd.stdout.split()[0]
+        return buildcache.cache_key(lockfile_hash, 'dependencies',
+                                    {'paths': self.paths, 'command': self.command})
+
+    def _record(self, hit):
+        hit_rate = self.cache.record(hit)
+        self.setProperty('dependencies_cached', hit, 'CachedDependencies')
+        self.setProperty('dependency_cache_hit_rate', round(hit_rate, 3), 'CachedDependencies')
+
+    @defer.inlineCallbacks
+    def run(self):
+        key = yield self._cache_key()
+        entry = self.cache.lookup(key) if key else None
+        if entry is not None:
+            cmd = yield buildcache.run_on_worker(
+                self, ['tar', '-xf', self.cache.archive_path(key)], 'cache')
+            if not cmd.didFail():
+                self.descriptionDone = 'dependencies cached from {} #{}'.format(
+                    entry['builder'], entry['number'])
+                self._record(True)
+                return SUCCESS
+
+        cmd = yield self.makeRemoteShellCommand()
+        yield self.runCommand(cmd)
+        results = cmd.results()
+        if key is None:
+            return results
+        self._record(False)
+
+        if results == SUCCESS:
+            # write under a unique name and rename, so that concurrent
+            # builds never see a partial archive
+            archive = self.cache.archive_path(key)
+            os.makedirs(self.cache.root, exist_ok=True)
+            stored = yield buildcache.run_on_worker(
+                self, 'tmp=$(mktemp {archive}.XXXXXX) && '
+                '{{ tar -cf "$tmp" {paths} && mv "$tmp" {archive} || {{ rm -f "$tmp"; false; }}; }}'.format(
+                    archive=shlex.quote(archive),
+                    paths=' '.join(shlex.quote(p) for p in self.paths)), 'cache')
+            if not stored.didFail():
+                self.cache.store(key, {'builder': self.build.builder.name,
+                                       'number': self.build.number})
+        return results
@@ -0,0 +1,72 @@
+import os
+import re
+import time
+
+from dateutil.parser import parse as dateparse
+from twisted.python import log
+from buildbot.www.hooks.github import GitHubEventHandler
+
+import gitpoller
+
+# The fields of a GitHub push payload's `repository` that name its URL
+REPOSITORY_URL_FIELDS = ('ssh_url', 'clone_url', 'git_url', 'html_url', 'svn_url', 'url')
+
+
+def repository_key(url):
+    """
+    Reduce the different spellings of a repository URL to one key, e.g.
+    ssh://git@github.com/klaital/names-api.git, git@github.com:klaital/names-api.git
+    and https://github.com/klaital/names-api all become github.com/klaital/names-api.
+    """
+    url = re.sub(r'^[a-z+]+://', '', url.strip().lower())
+    url = re.sub(r'^[^@/]+@', '', url)
+    url = url.replace(':', '/', 1)
+    return re.sub(r'(\.git)?/*$', '', url)
+
+
+class KGitHubEventHandler(GitHubEventHandler):
+    """
+    Handles GitHub push events by polling the KGitPoller for the pushed
+    repository right away, instead of building the changes from the payload.
+    The poller is then the only thing writing changes, so pushed and polled
+    changes are identical (buildPushesWithNoCommits included) and never
+    duplicated, and the regular poll is only a reconciliation fallback.
+    """
+
+    def _pollers_for(self, payload_repository):
+        keys = {repository_key(payload_repository[f])
+                for f in REPOSITORY_URL_FIELDS if payload_repository.get(f)}
+        return [cs for cs in self.master.change_svc
+                if isinstance(cs, gitpoller.KGitPoller) and repository_key(cs.repourl) in keys]
+
+    def handle_push(self, payload, event):
+        repository = payload['repository']
+        pollers = self._pollers_for(repository)
+        if not pollers:
+            log.msg('githubhook: ignoring push to unwatched repository {}'.format(
+                repository.get('full_name')))
+            return [], 'git'
+
+        head_commit = payload.get('head_commit') or {}
+        if head_commit.get('timestamp'):
+            latency = time.time() - dateparse(head_commit['timestamp']).timestamp()
+            log.msg('githubhook: push of {} to {} {} received {:.1f}s after commit'.format(
+                head_commit.get('id', '')[:8], repository.get('full_name'),
+                payload.get('ref'), latency))
+
+        for poller in pollers:
+            poller.force()
+
+        return [], 'git'
+
+
+def change_hook_dialects():
+    """The c['www']['change_hook_dialects'] entry for the GitHub push hook."""
+    secret = os.environ.get('GITHUB_WEBHOOK_SECRET')
+    return {
+        'github': {
+            'class': KGitHubEventHandler,
+            'secret': secret,
+            'strict': secret is not None,
+        },
+    }
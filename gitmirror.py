@@ -0,0 +1,124 @@
+import hashlib
+import os
+import re
+import shutil
+import time
+
+from twisted.internet import defer, task, threads, utils
+from twisted.python import log
+from buildbot.plugins import util
+from buildbot.util import service
+
+# One bare mirror per repository URL lives under here. The pollers fetch into
+# it and the worker checkouts borrow its objects with `git clone --reference`.
+MIRROR_ROOT = '/tmp/gitpoller-mirrors'
+
+# Mirrors that no configured poller uses any more are removed after this long.
+MIRROR_MAX_IDLE_SECONDS = 14 * 24 * 3600
+GC_INTERVAL_SECONDS = 24 * 3600
+
+_locks = {}
+
+
+def mirror_path(repourl):
+    """The bare mirror directory for a repository URL."""
+    readable = re.sub(r'[^A-Za-z0-9._-]+', '_', repourl.split('://')[-1]).strip('_')
+    digest = hashlib.sha1(repourl.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(MIRROR_ROOT, '{}-{}'.format(readable[-60:], digest))
+
+
+def mirror_lock(path):
+    """Serializes the git commands touching one mirror across all pollers."""
+    return _locks.setdefault(path, defer.DeferredLock())
+
+
+def reference_for(repourl):
+    """
+    A renderable for the `reference` argument of steps.Git. It points the
+    worker clone at the local mirror, or at nothing if the mirror has not
+    been created yet (the worker shares this host with the master).
+    """
+    @util.renderer
+    def _reference(props):
+        path = mirror_path(repourl)
+        if os.path.isdir(os.path.join(path, 'objects')):
+            return path
+        return None
+    return _reference
+
+
+def _last_fetched(path):
+    fetch_head = os.path.join(path, 'FETCH_HEAD')
+    if os.path.exists(fetch_head):
+        return os.path.getmtime(fetch_head)
+    return os.path.getmtime(path)
+
+
+def mirror_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class MirrorJanitor(service.BuildbotService):
+    """
+    Accounts for the disk used by the mirror store, runs `git gc` on the
+    mirrors still in use and deletes the ones no poller has touched in
+    MIRROR_MAX_IDLE_SECONDS.
+    """
+    name = 'git-mirror-janitor'
+
+    def reconfigService(self, repourls, root=MIRROR_ROOT, interval=GC_INTERVAL_SECONDS,
+                        max_idle=MIRROR_MAX_IDLE_SECONDS, gitbin='git'):
+        self.in_use = {mirror_path(url) for url in repourls}
+        self.root = root
+        self.interval = interval
+        self.max_idle = max_idle
+        self.gitbin = gitbin
+        self.sizes = {}
+        return super().reconfigService(name=self.name)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield super().startService()
+        self._loop = task.LoopingCall(self.collect)
+        self._loop.clock = self.master.reactor
+        self._loop.start(self.interval, now=False).addErrback(
+            log.err, 'while collecting git mirrors')
+
+    def stopService(self):
+        if self._loop.running:
+            self._loop.stop()
+        return super().stopService()
+
+    @defer.inlineCallbacks
+    def collect(self):
+        if not os.path.isdir(self.root):
+            return
+        now = time.time()
+        for entry in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, entry)
+            if not os.path.isdir(path):
+                continue
+            lock = mirror_lock(path)
+            yield lock.acquire()
+            try:
+                if path in self.in_use:
+                    yield utils.getProcessOutputAndValue(
+                        self.gitbin, ['gc', '--auto', '--quiet'], path=path)
+                elif now - _last_fetched(path) > self.max_idle:
+                    log.msg('gitmirror: removing unused mirror {}'.format(path))
+                    shutil.rmtree(path, ignore_errors=True)
+                    self.sizes.pop(path, None)
+                    continue
+                self.sizes[path] = yield threads.deferToThread(mirror_size, path)
+            finally:
+                lock.release()
+
+        log.msg('gitmirror: {} mirrors using {:.1f} MB in {}'.format(
+            len(self.sizes), sum(self.sizes.values()) / 1e6, self.root))
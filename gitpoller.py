@@ -1,9 +1,142 @@
+import os
+import re
+
 from buildbot.changes.gitpoller import GitPoller
 from twisted.internet import defer
 from twisted.python import log
 from buildbot.util import bytes2unicode
 
+import changedb
+import gitmirror
+import pollscheduler
+
+# Every commit is emitted as one record: NUL, then the fields separated by SOH.
+# The trailing SOH separates the formatted fields from the --name-only list.
+# (The ASCII RS/US separators would be eaten by the str.strip() in _dovccmd.)
+COMMIT_RECORD_SEP = '\x00'
+COMMIT_FIELD_SEP = '\x01'
+COMMIT_LOG_FORMAT = '--format=%x00%H%x01%ct%x01%aN <%aE>%x01%cN <%cE>%x01%s%n%b%x01'
+
+
 class KGitPoller(GitPoller):
+    def __init__(self, repourl, workdir=None, **kwargs):
+        # by default, poll into the shared bare mirror for this repository
+        if workdir is None:
+            workdir = gitmirror.mirror_path(repourl)
+        super().__init__(repourl, workdir=workdir, **kwargs)
+        self.pollChangeCount = 0
+        self.lastFetchDuration = None
+
+    # Polling is timed by pollscheduler.scheduler rather than by the
+    # per-poller loop of PollingChangeSource.
+
+    @defer.inlineCallbacks
+    def activate(self):
+        # make our workdir absolute, relative to the master's basedir
+        if not os.path.isabs(self.workdir):
+            self.workdir = os.path.join(self.master.basedir, self.workdir)
+            log.msg("gitpoller: using workdir '{}'".format(self.workdir))
+
+        try:
+            self.lastRev = yield self.getState('lastRev', {})
+            pollscheduler.scheduler.register(self)
+        except Exception as e:
+            log.err(e, 'while initializing GitPoller repository')
+
+    def deactivate(self):
+        return pollscheduler.scheduler.unregister(self)
+
+    def force(self):
+        pollscheduler.scheduler.poll_now(self)
+
+    def describe(self):
+        desc = super().describe()
+        next_poll = pollscheduler.scheduler.next_poll(self)
+        if self.master and next_poll is not None:
+            desc += ', next poll in {:.0f}s'.format(next_poll - self.master.reactor.seconds())
+        if self.lastFetchDuration is not None:
+            desc += ', last fetch took {:.1f}s'.format(self.lastFetchDuration)
+        return desc
+
+    @defer.inlineCallbacks
+    def _dovccmd(self, command, args, path=None):
+        if command != 'fetch':
+            return (yield super()._dovccmd(command, args, path=path))
+        started = self.master.reactor.seconds()
+        try:
+            return (yield super()._dovccmd(command, args, path=path))
+        finally:
+            self.lastFetchDuration = self.master.reactor.seconds() - started
+
+    @defer.inlineCallbacks
+    def poll(self):
+        # other pollers and the mirror janitor may be using the same mirror
+        lock = gitmirror.mirror_lock(self.workdir)
+        yield lock.acquire()
+        try:
+            yield super().poll()
+        finally:
+            lock.release()
+
+    def _decode_file(self, file):
+        # git use octal char sequences in quotes when non ASCII
+        match = re.match('^"(.*)"$', file)
+        if match:
+            file = bytes2unicode(match.groups()[0], encoding=self.encoding,
+                                 errors='unicode_escape')
+        return bytes2unicode(file, encoding=self.encoding)
+
+    def _parse_commit_log(self, output):
+        """
+        Yield one change record per commit in the output of a
+        COMMIT_LOG_FORMAT git log, in the order git printed them.
+        """
+        start = output.find(COMMIT_RECORD_SEP)
+        while start != -1:
+            end = output.find(COMMIT_RECORD_SEP, start + 1)
+            record = output[start + 1:end if end != -1 else len(output)]
+            start = end
+
+            rev, timestamp, author, committer, comments, files = \
+                record.split(COMMIT_FIELD_SEP, 5)
+
+            if self.usetimestamps:
+                try:
+                    timestamp = int(timestamp)
+                except Exception as e:
+                    log.msg(('gitpoller: caught exception converting output \'{}\' to timestamp'
+                             ).format(timestamp))
+                    raise e
+            else:
+                timestamp = None
+            author = author.strip()
+            if not author:
+                raise EnvironmentError('could not get commit author for rev')
+            committer = committer.strip()
+            if not committer:
+                raise EnvironmentError('could not get commit committer for rev')
+
+            yield {
+                'revision': rev.strip(),
+                'when_timestamp': timestamp,
+                'author': author,
+                'committer': committer,
+                'comments': comments.strip(),
+                'files': [self._decode_file(f) for f in files.splitlines() if len(f)],
+            }
+
+    @defer.inlineCallbacks
+    def _get_commit_log(self, revArgs):
+        """
+        Read the details of every commit selected by revArgs with a single
+        git log call, oldest first.
+        """
+        output = yield self._dovccmd(
+            'log', ['--name-only', COMMIT_LOG_FORMAT] + revArgs, path=self.workdir)
+        commits = list(self._parse_commit_log(output))
+        commits.reverse()
+        return commits
+
     @defer.inlineCallbacks
     def _process_changes(self, newRev, branch):
         """
@@ -18,68 +151,52 @@ class KGitPoller(GitPoller):
         if not self.lastRev:
             return
 
-        # get the change list
+        # get the change list, with all the details of every commit
         revListArgs = (['--ignore-missing'] +
-                       ['--format=%H', '{}'.format(newRev)] +
+                       ['{}'.format(newRev)] +
                        ['^' + rev
                         for rev in sorted(self.lastRev.values())] +
                        ['--'])
         self.changeCount = 0
-        results = yield self._dovccmd('log', revListArgs, path=self.workdir)
-
-        # process oldest change first
-        revList = results.split()
-        revList.reverse()
-
-        if self.buildPushesWithNoCommits and not revList:
-            existingRev = self.lastRev.get(branch)
-            if existingRev != newRev:
-                revList = [newRev]
-                if existingRev is None:
-                    # This branch was completely unknown, rebuild
-                    log.msg('gitpoller: rebuilding {} for new branch "{}"'.format(
-                        newRev, branch))
-                else:
-                    # This branch is known, but it now points to a different
-                    # commit than last time we saw it, rebuild.
-                    log.msg('gitpoller: rebuilding {} for updated branch "{}"'.format(
-                        newRev, branch))
+        try:
+            commits = yield self._get_commit_log(revListArgs)
+
+            if self.buildPushesWithNoCommits and not commits:
+                existingRev = self.lastRev.get(branch)
+                if existingRev != newRev:
+                    commits = yield self._get_commit_log(['--no-walk', newRev, '--'])
+                    if existingRev is None:
+                        # This branch was completely unknown, rebuild
+                        log.msg('gitpoller: rebuilding {} for new branch "{}"'.format(
+                            newRev, branch))
+                    else:
+                        # This branch is known, but it now points to a different
+                        # commit than last time we saw it, rebuild.
+                        log.msg('gitpoller: rebuilding {} for updated branch "{}"'.format(
+                            newRev, branch))
+        except Exception as e:
+            log.err(e, "while processing changes for {} {}".format(newRev, branch))
+            raise
 
+        revList = [commit['revision'] for commit in commits]
         self.changeCount = len(revList)
+        self.pollChangeCount += self.changeCount
         self.lastRev[branch] = newRev
 
         if self.changeCount:
             log.msg('gitpoller: processing {} changes: {} from "{}" branch "{}"'.format(
                 self.changeCount, revList, self.repourl, branch))
 
-        for rev in revList:
-            dl = defer.DeferredList([
-                self._get_commit_timestamp(rev),
-                self._get_commit_author(rev),
-                self._get_commit_committer(rev),
-                self._get_commit_files(rev),
-                self._get_commit_comments(rev),
-            ], consumeErrors=True)
-
-            results = yield dl
-
-            # check for failures
-            failures = [r[1] for r in results if not r[0]]
-            if failures:
-                for failure in failures:
-                    log.err(
-                        failure, "while processing changes for {} {}".format(newRev, branch))
-                # just fail on the first error; they're probably all related!
-                failures[0].raiseException()
-
-            timestamp, author, committer, files, comments = [r[1] for r in results]
-
-            yield self.master.data.updates.addChange(
-                author=author,
-                committer=committer,
-                revision=bytes2unicode(rev, encoding=self.encoding),
-                files=files, comments=comments, when_timestamp=timestamp,
-                branch=bytes2unicode(self._removeHeads(branch)),
-                project=self.project,
-                repository=bytes2unicode(self.repourl, encoding=self.encoding),
-                category=self.category, src='git')
+        # write the whole poll in one transaction, oldest change first
+        yield changedb.add_changes(self.master, [
+            dict(author=commit['author'],
+                 committer=commit['committer'],
+                 revision=bytes2unicode(commit['revision'], encoding=self.encoding),
+                 files=commit['files'], comments=commit['comments'],
+                 when_timestamp=commit['when_timestamp'],
+                 branch=bytes2unicode(self._removeHeads(branch)),
+                 project=self.project,
+                 repository=bytes2unicode(self.repourl, encoding=self.encoding),
+                 category=self.category, src='git')
+            for commit in commits
+        ])
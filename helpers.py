@@ -1,22 +1,44 @@
+import time
+
 from buildbot.plugins import *
-import yaml
 import standardservices
+import serviceconfig
 from buildbot.process.results import SKIPPED
+from twisted.python import log
+
+# Resources a worker advertises and a build consumes. Each one is a counting
+# WorkerLock whose per-worker maxCount is that worker's capacity, so builds
+# run concurrently for as long as the sum of their costs fits.
+WORKER_RESOURCES = ('cpu', 'memory_gb', 'disk_gb')
+
+# Buildbot rejects two lock objects with the same name in one config, so the
+# locks are only recreated when the capacities change (see serviceconfig.py)
+_resource_locks = {}
 
-WORKER_LOCK = util.WorkerLock('klaital_worker_lock', maxCount=1)
+def make_resource_locks(capacities, default_capacity):
+    key = repr([sorted(capacities.items()), sorted(default_capacity.items())])
+    if key not in _resource_locks:
+        _resource_locks.clear()
+        _resource_locks[key] = {
+            resource: util.WorkerLock(
+                'klaital_worker_' + resource,
+                maxCount=default_capacity[resource],
+                maxCountForWorker={w: capacities[w][resource] for w in capacities})
+            for resource in WORKER_RESOURCES
+        }
+    return _resource_locks[key]
 
-def load_yaml(file):
-    with open(file, 'r') as f:
-        try:
-            data = yaml.safe_load(f)
-            return data
+def resource_lock_accesses(locks, cost):
+    return [locks[resource].access('counting', count=cost[resource])
+            for resource in WORKER_RESOURCES]
 
-        except yaml.YAMLError as e:
-            print(e)
+def load_yaml(file, module=None):
+    return serviceconfig.load_yaml(file, module)
 
 @util.renderer
 def _get_helm_command(props):
-    branch = props.getProperty('branch')
+    # a coalesced deploy may be for another branch at the same revision
+    branch = props.getProperty('deploy_branch') or props.getProperty('branch')
     container_tag = props.getProperty('container_tag')
     script = '/home/chris/devel/buildbot-master/build_branch.sh'
     setopts = "-s containerTag={}".format(container_tag)
@@ -26,3 +48,25 @@ def _get_helm_command(props):
     values_file = branch[len('deploy-'):]
     return ['bash', script, setopts, cluster, namespace, chart_name, values_file]
 
+@util.renderer
+def _get_queue_wait(props):
+    # seconds the oldest request merged into this build waited for a worker
+    build = props.getBuild()
+    submitted = [req.submittedAt for req in build.requests if req.submittedAt]
+    if not submitted:
+        return None
+    wait = int(time.time() - min(submitted))
+    log.msg('queue wait for {}: {}s'.format(props.getProperty('buildername'), wait))
+    return wait
+
+@util.renderer
+def _get_commit_latency(props):
+    # seconds from the newest commit in this build to now, i.e. build start
+    build = props.getBuild()
+    whens = [change.when for change in build.allChanges() if change.when]
+    if not whens:
+        return None
+    latency = int(time.time() - max(whens))
+    log.msg('commit-to-build-start latency for {}: {}s'.format(
+        props.getProperty('buildername'), latency))
+    return latency
@@ -0,0 +1,216 @@
+import re
+
+from twisted.internet import defer
+from buildbot import config as bbconfig
+from buildbot.plugins import steps, util
+from buildbot.process import buildstep
+from buildbot.process.results import SUCCESS
+
+import buildcache
+
+# Where the tree hash -> pushed image mapping is kept
+IMAGE_INDEX_ROOT = '/tmp/buildbot-image-index'
+
+# Image builds use BuildKit, whose layer cache is kept by the worker's
+# docker daemon across builds
+DOCKER_ENV = {'DOCKER_BUILDKIT': '1'}
+
+# Images the step builds itself go through this buildx builder on each
+# worker. It runs BuildKit in a container, which can export its layer
+# cache; host networking lets it push to a registry on localhost.
+BUILDX_BUILDER = 'buildbot-layers'
+
+# BuildKit layer cache of each image target, on the worker host. Every
+# build reads it and writes a new one, which then replaces it, so it only
+# holds the layers of the last build.
+LAYER_CACHE_ROOT = '/tmp/buildbot-docker-layers'
+
+IMAGE_INDEX = buildcache.LocalBuildCache(root=IMAGE_INDEX_ROOT)
+
+# Prints the digest an image name points at in its registry
+_DIGEST_FORMAT = '{{.Manifest.Digest}}'
+
+
+def layer_cache_dir(target, root=LAYER_CACHE_ROOT):
+    """The layer cache directory of an image target under `root`."""
+    return '{}/{}'.format(root, re.sub(r'[^\w.-]', '_', target))
+
+
+class DedupedImagePush(buildstep.ShellMixin, buildstep.BuildStep):
+    """
+    Runs an image build-and-push command unless an image of the same git
+    tree (the `tree_hash` property) was already pushed to `target`.
+
+    If `image` (the exact name:tag the command pushes) is given, the digest
+    pushed for each tree is recorded, and a later build of the same tree is
+    retagged to its new `image` in the registry instead of being rebuilt.
+    A retag only counts once the registry has `image` at that digest.
+    Without `image`, the command is skipped only when the last image pushed
+    to `target` came from this same tree.
+
+    With a `context` directory instead of a command, the step builds and
+    pushes `image` itself, with `dockerfile` and `build_args`, through the
+    BUILDX_BUILDER and the target's layer cache under `layer_cache`.
+    """
+    renderables = ['target', 'image', 'build_args']
+
+    def __init__(self, target, image=None, index=IMAGE_INDEX, context=None, dockerfile=None,
+                 build_args=None, layer_cache=LAYER_CACHE_ROOT, **kwargs):
+        self.target = target
+        self.image = image
+        self.index = index
+        self.context = context
+        self.dockerfile = dockerfile
+        self.build_args = build_args or {}
+        self.layer_cache = layer_cache
+        if context is not None:
+            if image is None:
+                bbconfig.error("DedupedImagePush: a `context` needs the `image` to push")
+            if 'command' in kwargs:
+                bbconfig.error("DedupedImagePush: give either a `context` or a `command`")
+        kwargs = self.setupShellMixin(kwargs)
+        super().__init__(**kwargs)
+
+    def _keys(self, tree_hash):
+        return (buildcache.cache_key(tree_hash, 'image', {'target': self.target}),
+                buildcache.cache_key('', 'last-push', {'target': self.target}))
+
+    @defer.inlineCallbacks
+    def _run_docker(self, command, collectStdout=False):
+        cmd = yield buildcache.run_on_worker(self, command, 'dedupe', collectStdout=collectStdout)
+        return cmd
+
+    @defer.inlineCallbacks
+    def _registry_digest(self, image):
+        cmd = yield self._run_docker(
+            ['docker', 'buildx', 'imagetools', 'inspect', '--format', _DIGEST_FORMAT, image],
+            collectStdout=True)
+        return None if cmd.didFail() else cmd.stdout.strip() or None
+
+    def _record(self, key, entry):
+        entry.update({'results': SUCCESS, 'outputs': [], 'builder': self.build.builder.name,
+                      'number': self.build.number, 'url': None})
+        entry.setdefault('created', self.master.reactor.seconds())
+        self.index.store(key, entry)
+
+    @defer.inlineCallbacks
+    def _build_and_push(self):
+        """Builds and pushes `image` from `context` with the layer cache; returns the command."""
+        builder = yield self._run_docker(
+            ['sh', '-c', 'docker buildx inspect {0} >/dev/null 2>&1 || '
+                         'docker buildx create --name {0} --driver docker-container '
+                         '--driver-opt network=host'.format(BUILDX_BUILDER)])
+        if builder.didFail():
+            return builder
+
+        cache = layer_cache_dir(self.target, self.layer_cache)
+        new_cache = '{}.{}-{}'.format(cache, self.build.builder.name, self.build.number)
+        command = ['docker', 'buildx', 'build', '--builder', BUILDX_BUILDER,
+                   '--cache-from', 'type=local,src=' + cache,
+                   '--cache-to', 'type=local,mode=max,dest=' + new_cache,
+                   '--tag', self.image, '--push']
+        if self.dockerfile:
+            command += ['--file', self.dockerfile]
+        for name, value in sorted(self.build_args.items()):
+            command += ['--build-arg', '{}={}'.format(name, value)]
+        cmd = yield self.makeRemoteShellCommand(command=command + [self.context])
+        yield self.runCommand(cmd)
+
+        # the new cache replaces the old one, or is dropped if the build failed
+        yield self._run_docker(
+            ['sh', '-c', 'if [ -f "$1/index.json" ]; then rm -rf "$2" && mv -T "$1" "$2"; fi; '
+                         'rm -rf "$1"', 'sh', new_cache, cache])
+        return cmd
+
+    @defer.inlineCallbacks
+    def run(self):
+        tree_hash = self.getProperty('tree_hash')
+        self.setProperty('image_retagged', False, self.name)
+        if tree_hash:
+            image_key, last_push_key = self._keys(tree_hash)
+            pushed = self.index.lookup(image_key)
+            last_push = self.index.lookup(last_push_key)
+
+            if self.image is None:
+                if last_push is not None and last_push['tree_hash'] == tree_hash:
+                    self.descriptionDone = 'image for this tree already pushed by {} #{}'.format(
+                        last_push['builder'], last_push['number'])
+                    return SUCCESS
+            elif pushed is not None:
+                cmd = yield self._run_docker(['docker', 'buildx', 'imagetools', 'create',
+                                              '--tag', self.image, pushed['digest_ref']])
+                digest = None if cmd.didFail() else (yield self._registry_digest(self.image))
+                if digest is not None and pushed['digest_ref'].endswith('@' + digest):
+                    self.descriptionDone = 'retagged {} from {} #{}'.format(
+                        pushed['digest_ref'], pushed['builder'], pushed['number'])
+                    self.setProperty('image_retagged', True, self.name)
+                    self._record(last_push_key, {'tree_hash': tree_hash})
+                    return SUCCESS
+
+        if self.context is not None:
+            cmd = yield self._build_and_push()
+        else:
+            cmd = yield self.makeRemoteShellCommand()
+            yield self.runCommand(cmd)
+        results = cmd.results()
+        if not tree_hash or results != SUCCESS:
+            return results
+
+        if self.image is not None:
+            digest = yield self._registry_digest(self.image)
+            if digest is not None:
+                self._record(image_key, {'digest_ref': '{}@{}'.format(self.target, digest)})
+        self._record(last_push_key, {'tree_hash': tree_hash})
+        return results
+
+
+def add_check_steps(f, registry, name='dedupe-check', index=None):
+    """
+    Adds steps that push a small image to `registry` twice, from the same
+    tree, and fail unless the second push was a retag of the first image
+    that the registry serves under both tags. `registry` is started on
+    the worker as a `registry:2` container for the check and removed after.
+    """
+    port = registry.rpartition(':')[2]
+    container = 'buildbot-' + name + '-registry'
+    target = registry + '/' + name
+    index = index or buildcache.LocalBuildCache(root=IMAGE_INDEX_ROOT + '-' + name)
+
+    f.addStep(steps.ShellCommand(
+        name="start registry stand-in",
+        command=['sh', '-c',
+                 'docker rm -f {0} >/dev/null 2>&1; '
+                 'docker run -d --name {0} -p {1}:5000 registry:2 && '
+                 'for i in $(seq 30); do curl -sf http://{2}/v2/ >/dev/null && break; sleep 1; done && '
+                 'mkdir -p image && printf "FROM scratch\\nCOPY stamp /\\n" > image/Dockerfile && '
+                 'echo "$STAMP" > image/stamp'.format(container, port, registry)],
+        env={'STAMP': util.Interpolate('%(prop:buildername)s #%(prop:buildnumber)s')},
+        haltOnFailure=True))
+    f.addStep(steps.SetProperty(
+        name="set tree hash",
+        property='tree_hash',
+        value=util.Interpolate(name + '-%(prop:buildername)s-%(prop:buildnumber)s'),
+        hideStepIf=True))
+    for tag in ('first', 'second'):
+        f.addStep(DedupedImagePush(
+            name="push " + tag + " tag",
+            target=target,
+            image=target + ':' + tag,
+            index=index,
+            context='image',
+            haltOnFailure=True))
+    f.addStep(steps.ShellCommand(
+        name="check second tag is a retag",
+        command=['sh', '-c',
+                 'test "$RETAGGED" = True && '
+                 'test -f "{cache}/index.json" && '
+                 'test "$(docker buildx imagetools inspect --format \'{fmt}\' {0}:first)" = '
+                 '"$(docker buildx imagetools inspect --format \'{fmt}\' {0}:second)"'.format(
+                     target, fmt=_DIGEST_FORMAT,
+                     cache=layer_cache_dir(target))],
+        env={'RETAGGED': util.Interpolate('%(prop:image_retagged)s')},
+        haltOnFailure=True))
+    f.addStep(steps.ShellCommand(
+        name="stop registry stand-in",
+        command=['docker', 'rm', '-f', container],
+        alwaysRun=True))
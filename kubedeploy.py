@@ -0,0 +1,113 @@
+from twisted.internet import defer, task
+from buildbot.process import buildstep
+from buildbot.process.results import SUCCESS, FAILURE, CANCELLED
+
+import metrics
+
+# A realm must be rolled out and answering its liveness probe this many
+# seconds after its manifests were applied.
+READY_TIMEOUT_SECONDS = 600
+
+# Rollout status and liveness are polled after this many seconds, doubling
+# after each unsuccessful poll up to MAX_POLL_SECONDS.
+FIRST_POLL_SECONDS = 2
+MAX_POLL_SECONDS = 30
+
+# A liveness probe that takes longer than this counts as failed.
+PROBE_TIMEOUT_SECONDS = 5
+
+
+class KubeRollout(buildstep.ShellMixin, buildstep.BuildStep):
+    """
+    Applies a realm's manifests with `command` (kubectl apply, helm ...),
+    then polls `kubectl rollout status` for each of `resources` and the
+    HTTP `liveness_url` until they are all ready, backing off between
+    polls. The seconds from apply to ready are added to the
+    `deploy_ready_seconds` property, {realm: seconds}.
+    """
+    renderables = ['realm', 'kubeconfig', 'namespace', 'resources', 'liveness_url']
+
+    def __init__(self, realm, kubeconfig, resources, namespace=None, liveness_url=None,
+                 timeout=READY_TIMEOUT_SECONDS, kubectl='kubectl', curl='curl', **kwargs):
+        self.realm = realm
+        self.kubeconfig = kubeconfig
+        self.resources = resources
+        self.namespace = namespace
+        self.liveness_url = liveness_url
+        self.ready_timeout = timeout
+        self.kubectl = kubectl
+        self.curl = curl
+        kwargs = self.setupShellMixin(kwargs)
+        super().__init__(**kwargs)
+
+    def _kubectl(self, *args):
+        command = [self.kubectl, '--kubeconfig', self.kubeconfig]
+        if self.namespace:
+            command += ['--namespace', self.namespace]
+        return command + list(args)
+
+    @defer.inlineCallbacks
+    def _run(self, command):
+        cmd = yield self.makeRemoteShellCommand(command=command, collectStdout=True)
+        yield self.runCommand(cmd)
+        return cmd
+
+    @defer.inlineCallbacks
+    def _rolled_out(self, resource):
+        cmd = yield self._run(self._kubectl('rollout', 'status', '--watch=false', resource))
+        return not cmd.didFail() and 'successfully rolled out' in cmd.stdout
+
+    @defer.inlineCallbacks
+    def _live(self):
+        cmd = yield self._run([self.curl, '--silent', '--output', '/dev/null',
+                               '--write-out', '%{http_code}',
+                               '--max-time', str(PROBE_TIMEOUT_SECONDS), self.liveness_url])
+        return cmd.stdout.strip().startswith('2')
+
+    @defer.inlineCallbacks
+    def _wait_until(self, check, deadline):
+        delay = FIRST_POLL_SECONDS
+        while not self.stopped:
+            ready = yield check()
+            if ready:
+                return True
+            now = self.master.reactor.seconds()
+            if now >= deadline:
+                return False
+            yield task.deferLater(self.master.reactor, min(delay, deadline - now), lambda: None)
+            delay = min(delay * 2, MAX_POLL_SECONDS)
+        return False
+
+    @defer.inlineCallbacks
+    def run(self):
+        started = self.master.reactor.seconds()
+        deadline = started + self.ready_timeout
+        cmd = yield self._run(self.command)
+        if cmd.didFail():
+            self.descriptionDone = 'apply to {} failed'.format(self.realm)
+            return cmd.results()
+
+        waiting = list(self.resources)
+        for resource in self.resources:
+            ready = yield self._wait_until(lambda: self._rolled_out(resource), deadline)
+            if not ready:
+                break
+            waiting.remove(resource)
+        if not waiting and self.liveness_url:
+            live = yield self._wait_until(self._live, deadline)
+            if not live:
+                waiting.append(self.liveness_url)
+        if self.stopped:
+            return CANCELLED
+        if waiting:
+            self.descriptionDone = '{} not ready after {}s: {}'.format(
+                self.realm, self.ready_timeout, ' '.join(waiting))
+            return FAILURE
+
+        seconds = round(self.master.reactor.seconds() - started, 1)
+        ready_seconds = dict(self.getProperty('deploy_ready_seconds', {}), **{self.realm: seconds})
+        self.setProperty('deploy_ready_seconds', ready_seconds, 'KubeRollout')
+        metrics.observe('buildbot_deploy_ready_seconds', seconds, realm=self.realm)
+        self.descriptionDone = '{} ready in {}s'.format(self.realm, seconds)
+        return SUCCESS
+
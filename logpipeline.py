@@ -0,0 +1,206 @@
+import atexit
+import glob
+import gzip
+import os
+import shutil
+import threading
+
+from twisted.internet import defer
+from twisted.python import log
+from twisted.python.logfile import LogFile
+from buildbot.process import log as plog
+from buildbot.util import service
+
+# twistd.log lines are handed to a writer thread, which writes whatever
+# has queued up at least every LOG_FLUSH_SECONDS. If the disk stalls for
+# longer than LOG_MAX_PENDING_LINES lines, the oldest are dropped (and
+# counted in the log) rather than holding the master's memory.
+LOG_FLUSH_SECONDS = 0.5
+LOG_MAX_PENDING_LINES = 100000
+
+# Lines are written this many at a time, so the file still rotates close
+# to its rotateLength after a burst.
+LOG_WRITE_LINES = 1000
+
+# Step output is appended to the state database once LOG_BATCH_BYTES of it
+# have been collected, or LOG_BATCH_SECONDS after the first unsaved line,
+# instead of once per worker update. Batches are large enough for the
+# database's per-chunk compression to pay off, and stay below its 64 KiB
+# chunk size.
+LOG_BATCH_BYTES = 48 * 1024
+LOG_BATCH_SECONDS = 2
+
+
+class CompressedLogFile(LogFile):
+    """
+    A LogFile whose rotated files are gzipped, twistd.log.1.gz and so on.
+    Rotation happens inside write(), so on the writer thread.
+    """
+
+    def listLogs(self):
+        result = []
+        for name in glob.glob('%s.*.gz' % self.path):
+            counter = name[len(self.path) + 1:-len('.gz')]
+            if counter.isdigit() and int(counter):
+                result.append(int(counter))
+        return sorted(result)
+
+    def rotate(self):
+        if not (os.access(self.directory, os.W_OK) and os.access(self.path, os.W_OK)):
+            return
+        for i in reversed(self.listLogs()):
+            if self.maxRotatedFiles is not None and i >= self.maxRotatedFiles:
+                os.remove('%s.%d.gz' % (self.path, i))
+            else:
+                os.rename('%s.%d.gz' % (self.path, i), '%s.%d.gz' % (self.path, i + 1))
+        self._file.close()
+        os.rename(self.path, self.path + '.1')
+        self._openFile()
+        with open(self.path + '.1', 'rb') as src, gzip.open(self.path + '.1.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.remove(self.path + '.1')
+
+
+class ThreadedLogObserver(log.FileLogObserver):
+    """
+    Formats events like FileLogObserver, on the thread that logged them,
+    and leaves the writing, flushing and rotating of `logfile` to a thread
+    of its own.
+    """
+
+    def __init__(self, logfile, flush_seconds=LOG_FLUSH_SECONDS,
+                 max_pending=LOG_MAX_PENDING_LINES):
+        super().__init__(logfile)
+        self.logfile = logfile
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.write = self._queue
+        self.flush = lambda: None
+        self._pending = []
+        self._dropped = 0
+        self._closed = False
+        self._wakeup = threading.Condition()
+        self._thread = threading.Thread(target=self._writer, name='twistd.log writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _queue(self, text):
+        with self._wakeup:
+            self._pending.append(text)
+            if len(self._pending) > self.max_pending:
+                del self._pending[0]
+                self._dropped += 1
+
+    def _take(self):
+        with self._wakeup:
+            pending, self._pending = self._pending, []
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            pending.insert(0, '[logpipeline] dropped {} lines\n'.format(dropped))
+        return pending
+
+    def _write(self, pending):
+        for i in range(0, len(pending), LOG_WRITE_LINES):
+            self.logfile.write(''.join(pending[i:i + LOG_WRITE_LINES]))
+        if pending:
+            self.logfile.flush()
+
+    def _writer(self):
+        while True:
+            with self._wakeup:
+                if not self._closed:
+                    self._wakeup.wait(self.flush_seconds)
+                closed = self._closed
+            self._write(self._take())
+            if closed:
+                return
+
+    def close(self):
+        """Writes out everything logged so far and stops the writer."""
+        with self._wakeup:
+            self._closed = True
+            self._wakeup.notify()
+        self._thread.join()
+        self._write(self._take())
+
+
+class _BatchedLines(plog.Log):
+    """
+    Collects the whole lines of a step log and appends them to the
+    database in batches; finishing the log appends what is left first.
+    """
+    batch_bytes = LOG_BATCH_BYTES
+    batch_seconds = LOG_BATCH_SECONDS
+    _pending = None
+    _flush_call = None
+
+    def addRawLines(self, lines):
+        assert lines[-1] == '\n'
+        assert not self.finished
+        if self._pending is None:
+            self._pending, self._pending_bytes = [], 0
+        self._pending.append(lines)
+        self._pending_bytes += len(lines)
+        if self._pending_bytes >= self.batch_bytes:
+            return self._flush()
+        if self._flush_call is None:
+            self._flush_call = self.master.reactor.callLater(self.batch_seconds, self._timed_flush)
+        return defer.succeed(None)
+
+    def _timed_flush(self):
+        self._flush_call = None
+        self._flush().addErrback(log.err, 'while appending to log %d' % self.logid)
+
+    def _flush(self):
+        if self._flush_call is not None:
+            self._flush_call.cancel()
+            self._flush_call = None
+        if not self._pending:
+            return defer.succeed(None)
+        lines = ''.join(self._pending)
+        self._pending, self._pending_bytes = [], 0
+        return self.lock.run(lambda: self.master.data.updates.appendLog(self.logid, lines))
+
+    @defer.inlineCallbacks
+    def finish(self):
+        yield self._flush()
+        yield super().finish()
+
+
+class BatchedTextLog(plog.TextLog, _BatchedLines):
+    pass
+
+
+class BatchedHtmlLog(plog.HtmlLog, _BatchedLines):
+    pass
+
+
+class BatchedStreamLog(plog.StreamLog, _BatchedLines):
+    pass
+
+
+BATCHED_LOG_TYPES = {'t': BatchedTextLog, 'h': BatchedHtmlLog, 's': BatchedStreamLog}
+
+
+class LogBatching(service.BuildbotService):
+    """
+    Makes every step log of this master append its lines in batches of
+    `batch_bytes`, or after `batch_seconds`. Live subscribers still see
+    each line as it arrives; only the database writes are batched.
+    """
+    name = 'log-batching'
+
+    def reconfigService(self, batch_bytes=LOG_BATCH_BYTES, batch_seconds=LOG_BATCH_SECONDS):
+        _BatchedLines.batch_bytes = batch_bytes
+        _BatchedLines.batch_seconds = batch_seconds
+        return super().reconfigService(name=self.name)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield super().startService()
+        self._plain_types = {t: plog.Log._byType[t] for t in BATCHED_LOG_TYPES}
+        plog.Log._byType.update(BATCHED_LOG_TYPES)
+
+    def stopService(self):
+        plog.Log._byType.update(self._plain_types)
+        return super().stopService()
@@ -0,0 +1,93 @@
+import time
+
+from twisted.internet import defer
+from buildbot.process import buildstep
+from buildbot.process.results import SUCCESS, FAILURE
+
+import buildcache
+
+
+def _manifest_key(revision, service):
+    return buildcache.cache_key(revision, 'manifest', {'service': service})
+
+
+class BuildManifest(buildstep.ShellMixin, buildstep.BuildStep):
+    """
+    Sets the build's metadata properties in one step, after the checkout:
+
+    - `tree_hash` and `project_version` (`make version`), from one worker
+      command, or from the cache when this revision of the service was
+      built before
+    - `build_version`, `<project_version>-<branch>-<buildnumber>-<database
+      version>`, also the `container_tag`, and `container_name` and
+      `project_name`
+    - `artifact_version`, `<project_version>-<database version>`, the same
+      for every build of the revision
+    - `changed_paths`, the files touched by the build's changes
+    - `realm`, the realm `realms` maps the branch to, if any
+    """
+
+    def __init__(self, service, cache, registry, database_version, realms=None, **kwargs):
+        self.service = service
+        self.realms = realms or {}
+        self.cache = cache
+        self.registry = registry
+        self.database_version = database_version
+        kwargs.setdefault('name', 'build manifest')
+        kwargs.setdefault('command', ['sh', '-c', 'git rev-parse "HEAD^{tree}" && '
+                                      'make --no-print-directory version --always-make'])
+        kwargs = self.setupShellMixin(kwargs)
+        super().__init__(**kwargs)
+
+    @defer.inlineCallbacks
+    def _worker_manifest(self):
+        cmd = yield self.makeRemoteShellCommand(collectStdout=True)
+        yield self.runCommand(cmd)
+        lines = cmd.stdout.strip().split('\n', 1)
+        if cmd.didFail() or len(lines) < 2:
+            return cmd, None
+        return cmd, {'tree_hash': lines[0].strip(), 'project_version': lines[1].strip()}
+
+    @defer.inlineCallbacks
+    def run(self):
+        revision = self.getProperty('got_revision')
+        key = _manifest_key(revision, self.service) if revision else None
+        entry = self.cache.lookup(key) if key else None
+        if entry is not None:
+            source = 'cached from {} #{}'.format(entry['builder'], entry['number'])
+        else:
+            cmd, entry = yield self._worker_manifest()
+            if entry is None:
+                return cmd.results() if cmd.didFail() else FAILURE
+            source = 'computed'
+            if key:
+                self.cache.store(key, dict(entry, **{
+                    'results': SUCCESS,
+                    'outputs': [],
+                    'builder': self.build.builder.name,
+                    'number': self.build.number,
+                    'created': time.time(),
+                }))
+
+        build_version = '{}-{}-{}-{}'.format(
+            entry['project_version'], self.getProperty('branch'),
+            self.getProperty('buildnumber'), self.database_version)
+        changed = sorted({f for change in self.build.allChanges() for f in change.files})
+        properties = {
+            'tree_hash': entry['tree_hash'],
+            'project_version': entry['project_version'],
+            'build_version': build_version,
+            'artifact_version': '{}-{}'.format(entry['project_version'], self.database_version),
+            'container_name': self.registry + r'\/' + self.service,
+            'container_tag': build_version,
+            'project_name': self.service,
+            'changed_paths': changed,
+        }
+        if self.getProperty('branch') in self.realms:
+            properties['realm'] = self.realms[self.getProperty('branch')]
+        for name, value in properties.items():
+            self.setProperty(name, value, 'BuildManifest')
+        yield self.addCompleteLog('manifest', ''.join(
+            '{}: {}\n'.format(name, value) for name, value in sorted(properties.items())))
+        self.descriptionDone = '{} ({})'.format(build_version, source)
+        return SUCCESS
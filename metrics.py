@@ -0,0 +1,212 @@
+import bisect
+
+from twisted.internet import defer
+from twisted.python import log
+from twisted.web import resource, server
+from buildbot.process.results import SUCCESS, statusToString
+from buildbot.util import service
+
+import depcache
+
+# Prometheus scrapes http://<interface>:<port>/metrics
+METRICS_PORT = 9101
+METRICS_INTERFACE = '127.0.0.1'
+
+# Upper bounds, in seconds, of the histogram buckets
+SHORT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LONG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 14400, 28800, 86400)
+
+HISTOGRAMS = {
+    'buildbot_poll_seconds': (
+        'Duration of a whole poll of a repository, fetch included.', SHORT_BUCKETS),
+    'buildbot_poll_fetch_seconds': (
+        'Duration of the git fetch of a poll.', SHORT_BUCKETS),
+    'buildbot_change_insert_seconds': (
+        'Duration of the transaction adding one poll\'s changes to the database.', SHORT_BUCKETS),
+    'buildbot_queue_wait_seconds': (
+        'Seconds from a build request\'s submission to its build starting.', LONG_BUCKETS),
+    'buildbot_step_seconds': (
+        'Duration of each build step.', LONG_BUCKETS),
+    'buildbot_build_seconds': (
+        'Duration of each build.', LONG_BUCKETS),
+    'buildbot_commit_to_deploy_seconds': (
+        'Seconds from the newest commit of a successful realm build to its end.', LONG_BUCKETS),
+    'buildbot_deploy_ready_seconds': (
+        'Seconds from applying a realm\'s manifests to its rollout and liveness probe passing.',
+        LONG_BUCKETS),
+    'buildbot_db_batch_seconds': (
+        'Duration of one state database maintenance transaction.', SHORT_BUCKETS),
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry:
+    """
+    Histograms by metric name and label values. Recording is a dict lookup
+    and a bisect; all formatting is left to the scrape.
+    """
+
+    def __init__(self, histograms=HISTOGRAMS):
+        self.histograms = histograms
+        self.series = {name: {} for name in histograms}
+
+    def observe(self, name, value, **labels):
+        if value is None:
+            return
+        key = tuple(sorted(labels.items()))
+        series = self.series[name]
+        if key not in series:
+            series[key] = Histogram(self.histograms[name][1])
+        series[key].observe(value)
+
+    def render(self):
+        lines = []
+        for name in sorted(self.series):
+            lines.append('# HELP {} {}'.format(name, self.histograms[name][0]))
+            lines.append('# TYPE {} histogram'.format(name))
+            for key, h in sorted(self.series[name].items()):
+                total = 0
+                for bound, count in zip(h.buckets + ('+Inf',), h.counts):
+                    total += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(key + (('le', str(bound)),)), total))
+                lines.append('{}_sum{} {}'.format(name, _labels(key), repr(h.sum)))
+                lines.append('{}_count{} {}'.format(name, _labels(key), total))
+        return lines
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\')
+                                              .replace('"', r'\"').replace('\n', r'\n'))
+                          for k, v in pairs) + '}'
+
+
+def _sampled(lines, name, kind, description, samples):
+    lines.append('# HELP {} {}'.format(name, description))
+    lines.append('# TYPE {} {}'.format(name, kind))
+    for labels, value in samples:
+        if value is not None:
+            lines.append('{}{} {}'.format(name, _labels(labels), value))
+
+
+# Outlives reconfigs; the pollers and changedb record into it directly
+REGISTRY = Registry()
+
+
+def observe(name, value, **labels):
+    REGISTRY.observe(name, value, **labels)
+
+
+def render_metrics():
+    lines = REGISTRY.render()
+    counts = depcache.DEPENDENCY_CACHE.counts()
+    _sampled(lines, 'buildbot_dependency_cache_lookups_total', 'counter',
+           'Dependency cache lookups by outcome.',
+           [((('outcome', 'hit'),), counts['hits']), ((('outcome', 'miss'),), counts['misses'])])
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')
+        return render_metrics().encode('utf-8')
+
+
+class MetricsService(service.BuildbotService):
+    """
+    Serves REGISTRY in the Prometheus text format, and records the queue
+    wait, step durations and commit-to-deploy latency of every finished
+    build. Those are read back from the database once the build finished
+    event is out, so builds themselves do no extra work. Builders are
+    labelled by their tags, [service, realm or stage].
+    """
+    name = 'metrics'
+    address = None
+    _port = None
+
+    def checkConfig(self, realms, port=METRICS_PORT, interface=METRICS_INTERFACE):
+        pass
+
+    @defer.inlineCallbacks
+    def reconfigService(self, realms, port=METRICS_PORT, interface=METRICS_INTERFACE):
+        self.realms = set(realms)
+        self._builder_tags = {}
+        if self.address != (port, interface):
+            self.address = (port, interface)
+            if self.running:
+                yield self._listen()
+        yield super().reconfigService(name=self.name)
+
+    @defer.inlineCallbacks
+    def _listen(self):
+        if self._port is not None:
+            yield self._port.stopListening()
+        port, interface = self.address
+        self._port = self.master.reactor.listenTCP(
+            port, server.Site(_MetricsResource()), interface=interface)
+        log.msg('metrics: serving on http://{}:{}/metrics'.format(interface, port))
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield super().startService()
+        yield self._listen()
+        self._consumer = yield self.master.mq.startConsuming(
+            self._build_finished, ('builds', None, 'finished'))
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        self._consumer.stopConsuming()
+        if self._port is not None:
+            yield self._port.stopListening()
+            self._port = None
+        yield super().stopService()
+
+    @defer.inlineCallbacks
+    def _builder_labels(self, builderid):
+        if builderid not in self._builder_tags:
+            builder = yield self.master.data.get(('builders', builderid))
+            self._builder_tags[builderid] = (builder or {}).get('tags') or []
+        tags = self._builder_tags[builderid]
+        realm = next((t for t in tags[1:] if t in self.realms), None)
+        return {'service': tags[0] if tags else '',
+                'realm': realm or (tags[1] if len(tags) > 1 else '')}, realm is not None
+
+    @defer.inlineCallbacks
+    def _build_finished(self, key, build):
+        labels, is_realm = yield self._builder_labels(build['builderid'])
+        started, complete = build['started_at'], build['complete_at']
+        observe('buildbot_build_seconds', (complete - started).total_seconds(),
+                result=statusToString(build['results']), **labels)
+
+        request = yield self.master.data.get(('buildrequests', build['buildrequestid']))
+        if request:
+            observe('buildbot_queue_wait_seconds',
+                    (started - request['submitted_at']).total_seconds(), **labels)
+
+        build_steps = yield self.master.data.get(('builds', build['buildid'], 'steps'))
+        for step in build_steps:
+            if step['started_at'] and step['complete_at']:
+                observe('buildbot_step_seconds',
+                        (step['complete_at'] - step['started_at']).total_seconds(),
+                        step=step['name'], **labels)
+
+        if is_realm and build['results'] == SUCCESS:
+            changes = yield self.master.data.get(('builds', build['buildid'], 'changes'))
+            whens = [c['when_timestamp'] for c in changes if c['when_timestamp']]
+            if whens:
+                observe('buildbot_commit_to_deploy_seconds',
+                        complete.timestamp() - max(whens), **labels)
@@ -0,0 +1,58 @@
+from twisted.internet import defer
+from buildbot.process import buildstep
+from buildbot.process.results import SUCCESS, Results, computeResultAndTermination
+
+
+class ParallelGroup(buildstep.BuildStep):
+    """
+    Runs a group of steps concurrently on the build's worker, in the same
+    workdir. Each member is added to the build as its own step, with its own
+    logs; the group's `members` log lists the result of each one.
+
+    The group's result is the members' results merged the way the build
+    merges them (honouring each member's flunkOnFailure, warnOnFailure and
+    so on). When a member with haltOnFailure fails, the members still
+    running are interrupted and the group halts the build.
+    """
+
+    def __init__(self, steps, **kwargs):
+        self.group = steps
+        kwargs.setdefault('name', 'parallel')
+        kwargs.setdefault('warnOnWarnings', True)
+        super().__init__(**kwargs)
+        self.members = []
+
+    @defer.inlineCallbacks
+    def _run_member(self, member):
+        results = yield member.startStep(self.remote)
+        self.results_so_far, terminate = computeResultAndTermination(
+            member, results, self.results_so_far)
+        if terminate:
+            self.haltOnFailure = True
+            for other in self.members:
+                if other.results is None:
+                    other.interrupt('{} failed'.format(member.name))
+        return results
+
+    @defer.inlineCallbacks
+    def run(self):
+        self.members = self.build.setupBuildSteps(self.group)
+        # startStep gives each member a name unique in the build
+        for member in self.members:
+            self.build.executedSteps.append(member)
+
+        self.results_so_far = SUCCESS
+        member_results = yield defer.gatherResults(
+            [self._run_member(member) for member in self.members], consumeErrors=True)
+
+        yield self.addCompleteLog('members', ''.join(
+            '{}: {}\n'.format(member.name, Results[results])
+            for member, results in zip(self.members, member_results)))
+        self.descriptionDone = '{} steps in parallel'.format(len(self.members))
+        return self.results_so_far
+
+    def interrupt(self, reason):
+        for member in self.members:
+            if member.results is None:
+                member.interrupt(reason)
+        super().interrupt(reason)
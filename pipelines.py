@@ -0,0 +1,315 @@
+import inspect
+import json
+import re
+import weakref
+
+from buildbot import config as bbconfig
+from buildbot.plugins import util, steps, schedulers
+from buildbot.process import buildstep, remotecommand
+
+import serviceconfig
+import gitmirror
+import gitpoller
+import workspace
+import depcache
+import dbsnapshot
+import imagededupe
+import parallel
+import kubedeploy
+import sshdeploy
+
+CONFIG_PATH = 'services_config.yaml'
+
+# Keys every entry under `pipelines` must have, and every entry of its
+# `branches`
+REQUIRED_PIPELINE_KEYS = ('repo', 'workers', 'branches', 'steps')
+REQUIRED_BRANCH_KEYS = ('realm',)
+
+POLL_INTERVAL_SECONDS = 3600
+
+# Every step halts the build when it fails, unless its spec says otherwise
+STEP_DEFAULTS = {'haltOnFailure': True}
+
+# Environments a step's `env` may name, alone or in a list with mappings
+ENVIRONMENTS = {
+    'go': depcache.GO_MODULE_ENV,
+    'docker': imagededupe.DOCKER_ENV,
+}
+
+# `{name}` in a step argument is the branch's (or the pipeline's) value of
+# `name`; an argument that is nothing else takes the value as is, list or
+# null. Strings with `%(prop:...)s` become Interpolates.
+_VARIABLE = re.compile(r'\{(\w+)\}')
+
+
+def _git_sync(**kwargs):
+    kwargs.setdefault('name', 'git sync')
+    return workspace.WarmGit(reference=gitmirror.reference_for(kwargs['repourl']), **kwargs)
+
+
+def _tree_hash(**kwargs):
+    kwargs.setdefault('name', 'set property from tree hash')
+    return steps.SetPropertyFromCommand(
+        command=['git', 'rev-parse', 'HEAD^{tree}'], property='tree_hash', **kwargs)
+
+
+def _parallel(steps, **kwargs):
+    return parallel.ParallelGroup(steps=[_make_step(spec) for spec in steps], **kwargs)
+
+
+# The `type` of a step -> what makes it from the spec's other keys
+STEP_TYPES = {
+    'git': _git_sync,
+    'tree_hash': _tree_hash,
+    'shell': steps.ShellCommand,
+    'dependencies': depcache.CachedDependencies,
+    'migrate': dbsnapshot.SnapshotMigrate,
+    'image': imagededupe.DedupedImagePush,
+    'parallel': _parallel,
+    'kubernetes': kubedeploy.KubeRollout,
+    'ssh': sshdeploy.SSHDeploy,
+}
+
+# The step class behind each type STEP_TYPES makes with a function, and the
+# arguments that function sets itself
+_WRAPPED_STEPS = {
+    'git': (workspace.WarmGit, {'reference'}),
+    'tree_hash': (steps.SetPropertyFromCommand, {'command', 'property'}),
+    'parallel': (parallel.ParallelGroup, set()),
+}
+
+# Keys of a step spec that are not arguments of the step
+_SPEC_KEYS = {'type', 'when'}
+
+
+def _step_arguments(step_type):
+    """The arguments a step type takes, and those of them it requires."""
+    cls, preset = _WRAPPED_STEPS.get(step_type, (STEP_TYPES[step_type], set()))
+    names, required = set(), None
+    for klass in cls.__mro__:
+        if klass is buildstep.BuildStep or '__init__' not in vars(klass):
+            continue
+        params = list(inspect.signature(vars(klass)['__init__']).parameters.values())[1:]
+        named = [p for p in params if p.kind not in (p.VAR_POSITIONAL, p.VAR_KEYWORD)]
+        names.update(p.name for p in named)
+        if required is None:
+            required = {p.name for p in named if p.default is p.empty}
+        if not any(p.kind is p.VAR_KEYWORD for p in params):
+            break
+    # BuildStep takes its `parms`; ShellMixin steps their shell arguments,
+    # and old-style shell steps pass the rest to their RemoteShellCommand
+    names.update(buildstep.BuildStep.parms)
+    if issubclass(cls, buildstep.ShellMixin):
+        names.update(buildstep.ShellMixin._shellMixinArgs)
+    if issubclass(cls, steps.ShellCommand):
+        names.update(inspect.signature(remotecommand.RemoteShellCommand).parameters)
+    return names - preset, (required or set()) - preset
+
+
+class LazyFactory(util.BuildFactory):
+    """
+    A BuildFactory that has `make_steps(factory)` add its steps when they
+    are first needed, which is when the first build of one of its builders
+    starts. Until then a builder costs the master its BuilderConfig only.
+    """
+
+    def __init__(self, make_steps):
+        self._make_steps = make_steps
+        self._steps = None
+
+    @property
+    def steps(self):
+        if self._steps is None:
+            # only keep the steps once all of them were made
+            factory = util.BuildFactory()
+            self._make_steps(factory)
+            self._steps = factory.steps
+        return self._steps
+
+
+# Factories by their key. Builders whose steps have the same key share one
+# factory, which lives for as long as a builder of the config uses it.
+_factories = weakref.WeakValueDictionary()
+
+
+def shared_factory(key, make_steps):
+    """The LazyFactory for `key`, JSON describing everything its steps depend on."""
+    key = json.dumps(key, sort_keys=True, default=repr)
+    factory = _factories.get(key)
+    if factory is None:
+        factory = _factories[key] = LazyFactory(make_steps)
+    return factory
+
+
+def _substitute(value, variables):
+    if isinstance(value, str):
+        whole = _VARIABLE.fullmatch(value)
+        if whole:
+            return variables.get(whole.group(1))
+        return _VARIABLE.sub(
+            lambda m: str(variables[m.group(1)]) if m.group(1) in variables else m.group(0),
+            value)
+    if isinstance(value, list):
+        return [_substitute(v, variables) for v in value]
+    if isinstance(value, dict):
+        return {k: _substitute(v, variables) for k, v in value.items()}
+    return value
+
+
+def _resolve_step(spec, variables):
+    """A step spec with the branch's variables, `when` and `env` filled in."""
+    if isinstance(spec, str):
+        spec = {'type': spec}
+    spec = dict(STEP_DEFAULTS, **spec)
+    if 'when' in spec:
+        spec['doStepIf'] = bool(variables.get(spec.pop('when')))
+    if 'env' in spec:
+        env = {}
+        for part in spec['env'] if isinstance(spec['env'], list) else [spec['env']]:
+            env.update(ENVIRONMENTS[part] if isinstance(part, str) else part)
+        spec['env'] = env
+    if spec['type'] == 'git':
+        spec.setdefault('repourl', variables['repo'])
+    if spec['type'] == 'parallel':
+        spec['steps'] = [_resolve_step(s, variables) for s in spec['steps']]
+    return {k: v if k == 'steps' else _substitute(v, variables) for k, v in spec.items()}
+
+
+def _renderable(value):
+    if isinstance(value, str) and '%(' in value:
+        return util.Interpolate(value)
+    if isinstance(value, list):
+        return [_renderable(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _renderable(v) for k, v in value.items()}
+    return value
+
+
+def _make_step(spec):
+    kwargs = {k: v if k == 'steps' else _renderable(v) for k, v in spec.items() if k != 'type'}
+    return STEP_TYPES[spec['type']](**kwargs)
+
+
+def _add_steps(f, resolved):
+    for spec in resolved:
+        f.addStep(_make_step(spec))
+
+
+def _variables(p_name, pipeline, branch):
+    variables = {'name': p_name, 'branch': branch}
+    variables.update((k, v) for k, v in pipeline.items() if not isinstance(v, (list, dict)))
+    variables.update(pipeline['branches'][branch] or {})
+    return variables
+
+
+def _validate_steps(path, p_name, specs):
+    ok = True
+    for spec in specs:
+        if isinstance(spec, str):
+            spec = {'type': spec}
+        step_type = spec.get('type')
+        if step_type not in STEP_TYPES:
+            bbconfig.error('{}: pipeline {!r}: unknown step type {!r}'.format(
+                path, p_name, step_type))
+            ok = False
+        else:
+            names, required = _step_arguments(step_type)
+            for key in sorted(set(spec) - _SPEC_KEYS - names):
+                bbconfig.error('{}: pipeline {!r}: {} step has no argument {!r}'.format(
+                    path, p_name, step_type, key))
+                ok = False
+            for key in sorted(required - set(spec)):
+                bbconfig.error('{}: pipeline {!r}: {} step is missing {!r}'.format(
+                    path, p_name, step_type, key))
+                ok = False
+            if step_type == 'parallel':
+                ok = _validate_steps(path, p_name, spec.get('steps') or []) and ok
+        env = spec.get('env', [])
+        for part in env if isinstance(env, list) else [env]:
+            if isinstance(part, str) and part not in ENVIRONMENTS:
+                bbconfig.error('{}: pipeline {!r}: unknown env {!r}'.format(path, p_name, part))
+                ok = False
+    return ok
+
+
+def validate_pipeline(path, p_name, pipeline):
+    """Reports what is wrong with a pipeline's entry; returns whether it can be built."""
+    ok = True
+    for key in REQUIRED_PIPELINE_KEYS:
+        if key not in pipeline:
+            bbconfig.error('{}: pipeline {!r} is missing {!r}'.format(path, p_name, key))
+            ok = False
+    for branch, entry in (pipeline.get('branches') or {}).items():
+        for key in REQUIRED_BRANCH_KEYS:
+            if key not in (entry or {}):
+                bbconfig.error('{}: pipeline {!r}: branch {!r} is missing {!r}'.format(
+                    path, p_name, branch, key))
+                ok = False
+    return _validate_steps(path, p_name, pipeline.get('steps') or []) and ok
+
+
+def _make_pipeline_objects(p_name, pipeline, factories):
+    objects = {'change_source': [], 'builders': [], 'schedulers': []}
+    objects['change_source'].append(gitpoller.KGitPoller(
+        repourl=pipeline['repo'],
+        branches=True,
+        buildPushesWithNoCommits=True,
+        pollInterval=pipeline.get('poll_interval', POLL_INTERVAL_SECONDS),
+        pollAtLaunch=True,
+        project=pipeline.get('project', p_name)))
+
+    for branch in sorted(pipeline['branches']):
+        variables = _variables(p_name, pipeline, branch)
+        buildername = '{}-{}'.format(p_name, variables['realm'])
+        objects['builders'].append(util.BuilderConfig(
+            name=buildername,
+            workernames=pipeline['workers'],
+            factory=factories[branch],
+            tags=_substitute(pipeline.get('tags', []), variables) + variables.get('tags', [])))
+        objects['schedulers'].append(schedulers.ForceScheduler(
+            name='force-{}-{}'.format(p_name, variables['realm']),
+            codebases=[
+                util.CodebaseParameter(
+                    "",
+                    label="Repository",
+                    branch=util.FixedParameter(name="branch", default=branch),
+                    revision=util.StringParameter(name="revision", default=""),
+                    repository=util.FixedParameter(name="repository", default=pipeline['repo']),
+                    project=util.FixedParameter(
+                        name="project", default=pipeline.get('project', p_name)),
+                )
+            ],
+            builderNames=[buildername]))
+    return objects
+
+
+# Each pipeline's objects survive reconfigs that leave its entry unchanged
+PIPELINE_OBJECTS = serviceconfig.registry(__name__)
+
+
+def _pipeline_objects():
+    """name -> the objects of every enabled pipeline."""
+    config = serviceconfig.load_yaml(CONFIG_PATH)
+    objects = {}
+    for p_name, pipeline in sorted((config.get('pipelines') or {}).items()):
+        if not validate_pipeline(CONFIG_PATH, p_name, pipeline) or \
+                not pipeline.get('enabled', True):
+            continue
+        factories = {}
+        for branch in pipeline['branches']:
+            resolved = [_resolve_step(spec, _variables(p_name, pipeline, branch))
+                        for spec in pipeline['steps']]
+            factories[branch] = shared_factory(
+                resolved, lambda f, resolved=resolved: _add_steps(f, resolved))
+        objects[p_name] = PIPELINE_OBJECTS.get(
+            p_name, pipeline,
+            lambda: _make_pipeline_objects(p_name, pipeline, factories))
+    return objects
+
+
+def add_all_pipelines(cfg):
+    """Adds the change sources, schedulers and builders of every enabled pipeline."""
+    for objects in _pipeline_objects().values():
+        cfg['change_source'].extend(objects['change_source'])
+        cfg['schedulers'].extend(objects['schedulers'])
+        cfg['builders'].extend(objects['builders'])
@@ -0,0 +1,152 @@
+import random
+
+from twisted.internet import defer
+from twisted.python import log
+
+import metrics
+
+# At most this many KGitPollers fetch at the same time.
+MAX_CONCURRENT_POLLS = 2
+
+# Polls at master start are spread over this many seconds, so that a
+# restart does not fetch every repository at once.
+LAUNCH_SPREAD_SECONDS = 120
+
+# Each repository's interval adapts between this floor and the pollInterval
+# the poller was configured with: halved when a poll found changes, grown by
+# BACKOFF_FACTOR when it did not.
+MIN_POLL_INTERVAL_SECONDS = 300
+BACKOFF_FACTOR = 1.5
+
+# Every wait is randomized by +/- this fraction to keep pollers out of lockstep.
+JITTER = 0.1
+
+
+class _PollState:
+    def __init__(self, poller, interval):
+        self.poller = poller
+        self.interval = interval
+        self.next_poll = None
+        self.call = None
+        self.running = None
+        self.pending = False
+        self.last_poll_seconds = None
+        self.last_fetch_seconds = None
+        self.last_changes = None
+
+
+class PollScheduler:
+    """
+    Owns the timers of every KGitPoller: caps the number of concurrent
+    polls, jitters their start times and adapts each repository's interval
+    to how often it actually changes.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_POLLS):
+        self.semaphore = defer.DeferredSemaphore(max_concurrent)
+        # keyed by id(): pollers compare equal to their reconfigured copies
+        self.states = {}
+
+    def register(self, poller):
+        state = _PollState(poller, poller.pollInterval)
+        self.states[id(poller)] = state
+        if poller.pollAtLaunch:
+            delay = random.uniform(0, min(state.interval, LAUNCH_SPREAD_SECONDS))
+        else:
+            delay = self._jittered(state.interval)
+        self._schedule(state, delay)
+
+    def unregister(self, poller):
+        """Stop polling; the returned Deferred fires once any running poll is done."""
+        state = self.states.pop(id(poller), None)
+        if state is None:
+            return defer.succeed(None)
+        if state.call is not None and state.call.active():
+            state.call.cancel()
+        if state.running is not None:
+            d = defer.Deferred()
+            state.running.addBoth(lambda _: d.callback(None))
+            return d
+        return defer.succeed(None)
+
+    def poll_now(self, poller):
+        state = self.states.get(id(poller))
+        if state is None:
+            return
+        if state.running is not None:
+            state.pending = True
+        else:
+            self._schedule(state, 0)
+
+    def next_poll(self, poller):
+        state = self.states.get(id(poller))
+        return state.next_poll if state is not None else None
+
+    def stats(self):
+        """Per-repository interval, next poll time and last poll/fetch durations."""
+        return [{
+            'name': state.poller.name,
+            'repourl': state.poller.repourl,
+            'interval': state.interval,
+            'next_poll': state.next_poll,
+            'last_poll_seconds': state.last_poll_seconds,
+            'last_fetch_seconds': state.last_fetch_seconds,
+            'last_changes': state.last_changes,
+        } for state in self.states.values()]
+
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def _schedule(self, state, delay):
+        if state.call is not None and state.call.active():
+            state.call.cancel()
+        reactor = state.poller.master.reactor
+        state.next_poll = reactor.seconds() + delay
+        state.call = reactor.callLater(delay, self._run, state)
+
+    @defer.inlineCallbacks
+    def _run(self, state):
+        state.call = None
+        state.next_poll = None
+        state.running = self.semaphore.run(self._poll, state)
+        try:
+            yield state.running
+        finally:
+            state.running = None
+
+        if self.states.get(id(state.poller)) is not state:
+            # unregistered while polling
+            return
+        if state.pending:
+            state.pending = False
+            self._schedule(state, 0)
+        else:
+            self._schedule(state, self._jittered(state.interval))
+
+    @defer.inlineCallbacks
+    def _poll(self, state):
+        poller = state.poller
+        reactor = poller.master.reactor
+        started = reactor.seconds()
+        poller.pollChangeCount = 0
+        try:
+            yield poller.poll()
+        except Exception as e:
+            log.err(e, 'while polling {}'.format(poller.repourl))
+
+        state.last_poll_seconds = reactor.seconds() - started
+        state.last_fetch_seconds = poller.lastFetchDuration
+        state.last_changes = poller.pollChangeCount
+        metrics.observe('buildbot_poll_seconds', state.last_poll_seconds, repository=poller.repourl)
+        metrics.observe('buildbot_poll_fetch_seconds', state.last_fetch_seconds,
+                        repository=poller.repourl)
+        if state.last_changes:
+            state.interval = max(MIN_POLL_INTERVAL_SECONDS, state.interval / 2)
+        else:
+            state.interval = min(poller.pollInterval, state.interval * BACKOFF_FACTOR)
+
+        log.msg('pollscheduler: polled {} in {:.1f}s ({} changes), next poll in ~{:.0f}s'.format(
+            poller.repourl, state.last_poll_seconds, state.last_changes, state.interval))
+
+
+scheduler = PollScheduler()
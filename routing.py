@@ -0,0 +1,81 @@
+import fnmatch
+import re
+
+from twisted.internet import defer
+from twisted.python import log
+from buildbot.schedulers import base
+from buildbot.util import ComparableMixin
+
+
+def compile_globs(patterns):
+    """One regex for a list of fnmatch patterns (where `*` also matches `/`)."""
+    if not patterns:
+        return None
+    return re.compile('|'.join(fnmatch.translate(p) for p in patterns))
+
+
+class PathRule(ComparableMixin):
+    """
+    Which changes concern a service: a change matches when it touches a file
+    that matches `paths` (any file, if not given) and not `ignore_paths`.
+    Changes without a file list always match.
+    """
+
+    compare_attrs = ('paths', 'ignore_paths')
+
+    def __init__(self, paths=None, ignore_paths=None):
+        self.paths = list(paths or [])
+        self.ignore_paths = list(ignore_paths or [])
+        self._paths = compile_globs(self.paths)
+        self._ignore = compile_globs(self.ignore_paths)
+
+    def matches(self, files):
+        if not files:
+            return True
+        for f in files:
+            if self._ignore is not None and self._ignore.match(f):
+                continue
+            if self._paths is None or self._paths.match(f):
+                return True
+        return False
+
+
+class RoutingScheduler(base.BaseScheduler):
+    """
+    One scheduler for every subscription, in place of a SingleBranchScheduler
+    per subscription. Each new change is fetched once and looked up in
+    `routes`, {(repository, branch): [(PathRule, [builder names])]}; a
+    buildset for it is started right away, as with treeStableTimer=0, on the
+    builders whose rule matches the change's files. Changes that match no
+    rule stay recorded but build nothing.
+    """
+
+    compare_attrs = base.BaseScheduler.compare_attrs + ('routes',)
+
+    def __init__(self, name, routes, **kwargs):
+        self.routes = {key: [(rule, sorted(set(names))) for rule, names in subscriptions]
+                       for key, subscriptions in routes.items()}
+        builderNames = sorted({b for subscriptions in self.routes.values()
+                               for _, names in subscriptions for b in names})
+        super().__init__(name, builderNames, **kwargs)
+        self.reason = "The RoutingScheduler scheduler named '{}' triggered this build".format(name)
+
+    @defer.inlineCallbacks
+    def activate(self):
+        yield super().activate()
+        if not self.enabled:
+            return
+        yield self.startConsumingChanges()
+
+    def gotChange(self, change, important):
+        subscriptions = self.routes.get((change.repository, change.branch))
+        if not subscriptions:
+            return defer.succeed(None)
+        builderNames = sorted({b for rule, names in subscriptions
+                               if rule.matches(change.files) for b in names})
+        if not builderNames:
+            log.msg('{}: change {} touches no built paths ({} files), not building'.format(
+                self.name, change.number, len(change.files)))
+            return defer.succeed(None)
+        return self.addBuildsetForChanges(reason=self.reason, changeids=[change.number],
+                                          builderNames=builderNames)
@@ -0,0 +1,156 @@
+import copy
+import importlib
+import json
+import os
+import sys
+import time
+
+import yaml
+from buildbot import config as bbconfig
+from twisted.python import log
+
+# YAML paths are relative to this repository, wherever the master runs from
+CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Keys every entry under `services` must have, and the type of each key an
+# entry may have
+REQUIRED_SERVICE_KEYS = ('giturl', 'run_tests', 'fail_on_tests')
+SERVICE_KEY_TYPES = {
+    'giturl': str,
+    'run_tests': bool,
+    'fail_on_tests': bool,
+    'build_outputs': list,
+    'test_shards': int,
+    'resources': dict,
+    'paths': list,
+    'ignore_paths': list,
+}
+REQUIRED_SECTIONS = ('branch_to_realm_mapping', 'services', 'worker_capacity',
+                     'default_build_resources', 'kubernetes')
+
+# libyaml's parser where PyYAML was built with it; the pure Python one takes
+# seconds once the config describes a few hundred projects
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# path -> (mtime, parsed YAML), and path -> names of the modules that loaded it
+_parsed = {}
+_loaded_by = {}
+
+# name -> ServiceObjects; these outlive the modules reloaded on reconfig
+_registries = {}
+
+_reconfig_started = None
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def load_yaml(path, module=None):
+    """
+    Parses a YAML file relative to this repository; later calls get a copy
+    of the same data until the file is modified. `module` (the caller's
+    __name__) is reloaded by begin_reconfig once the file changes.
+    """
+    path = os.path.join(CONFIG_DIR, path)
+    mtime = _mtime(path)
+    if path not in _parsed or _parsed[path][0] != mtime:
+        with open(path, 'r') as f:
+            try:
+                _parsed[path] = (mtime, yaml.load(f, Loader=_YAML_LOADER))
+            except yaml.YAMLError as e:
+                bbconfig.error('{}: {}'.format(path, e), always_raise=True)
+    if module is not None:
+        _loaded_by.setdefault(path, set()).add(module)
+    return copy.deepcopy(_parsed[path][1])
+
+
+def validate_services(config, path):
+    for section in REQUIRED_SECTIONS:
+        if section not in config:
+            bbconfig.error('{}: missing section {!r}'.format(path, section))
+    for name, entry in (config.get('services') or {}).items():
+        for key in REQUIRED_SERVICE_KEYS:
+            if key not in entry:
+                bbconfig.error('{}: service {!r} is missing {!r}'.format(path, name, key))
+        for key, value in entry.items():
+            if key in SERVICE_KEY_TYPES and not isinstance(value, SERVICE_KEY_TYPES[key]):
+                bbconfig.error('{}: service {!r}: {!r} must be a {}'.format(
+                    path, name, key, SERVICE_KEY_TYPES[key].__name__))
+
+
+def begin_reconfig():
+    """
+    Call first thing in master.cfg: reloads the modules whose YAML changed
+    since they loaded it, so that master.cfg sees the new configuration.
+    """
+    global _reconfig_started
+    _reconfig_started = time.time()
+    stale = set()
+    for path, modules in _loaded_by.items():
+        if _mtime(path) != _parsed[path][0]:
+            stale.update(modules)
+    for name in sorted(stale):
+        if name in sys.modules:
+            log.msg('serviceconfig: configuration of {} changed, reloading it'.format(name))
+            importlib.reload(sys.modules[name])
+    for registry in _registries.values():
+        registry.begin()
+
+
+def end_reconfig():
+    """Call last thing in master.cfg: logs what this reconfig replaced."""
+    for name, registry in _registries.items():
+        registry.end(name)
+    if _reconfig_started is not None:
+        log.msg('serviceconfig: master.cfg evaluated in {:.2f}s'.format(
+            time.time() - _reconfig_started))
+
+
+def registry(name):
+    if name not in _registries:
+        _registries[name] = ServiceObjects()
+    return _registries[name]
+
+
+class ServiceObjects:
+    """
+    The builders, schedulers and change sources built for each service,
+    kept with the configuration they were built from. As long as a service's
+    configuration is unchanged, every reconfig hands the running objects
+    back to the master, which then leaves them alone.
+    """
+
+    def __init__(self):
+        self.built = {}
+        self.begin()
+
+    def begin(self):
+        self.seen = set()
+        self.rebuilt = set()
+
+    def get(self, name, config, build):
+        key = json.dumps(config, sort_keys=True, default=repr)
+        if name not in self.built or self.built[name][0] != key:
+            self.built[name] = (key, build())
+            self.rebuilt.add(name)
+        self.seen.add(name)
+        return self.built[name][1]
+
+    def end(self, registry_name):
+        removed = sorted(set(self.built) - self.seen)
+        for name in removed:
+            del self.built[name]
+        touched = {}
+        for name in self.rebuilt:
+            for kind, objects in self.built[name][1].items():
+                touched[kind] = touched.get(kind, 0) + len(objects)
+        log.msg('serviceconfig: {}: rebuilt {} ({}), reused {}, removed {} ({})'.format(
+            registry_name, len(self.rebuilt), ', '.join(sorted(self.rebuilt)) or '-',
+            len(self.seen - self.rebuilt), len(removed),
+            ', '.join('{} {}'.format(n, kind) for kind, n in sorted(touched.items())) or
+            'no objects replaced'))
+        self.begin()
@@ -0,0 +1,160 @@
+import shlex
+import time
+
+from twisted.internet import defer
+from buildbot.plugins import steps
+from buildbot.process import buildstep
+from buildbot.process.results import SUCCESS, FAILURE
+
+import buildcache
+
+# Tests with no recorded duration are assumed to take this long
+DEFAULT_TEST_SECONDS = 10.0
+
+# Weight of the latest run in a test's recorded duration
+DURATION_SMOOTHING = 0.5
+
+# Shards of different builds finish concurrently; the read-modify-write of
+# the durations in the master's state is serialized through this lock.
+_durations_lock = defer.DeferredLock()
+
+
+def _passed_key(tree_hash, service):
+    return buildcache.cache_key(tree_hash, 'passed-tests', {'service': service})
+
+
+def split_shards(tests, durations, shards):
+    """Longest-first assignment of tests to the currently shortest shard."""
+    known = [durations[t] for t in tests if t in durations]
+    default = sum(known) / len(known) if known else DEFAULT_TEST_SECONDS
+    buckets = [[] for _ in range(min(shards, len(tests)))]
+    totals = [0.0] * len(buckets)
+    for test in sorted(tests, key=lambda t: durations.get(t, default), reverse=True):
+        i = totals.index(min(totals))
+        buckets[i].append(test)
+        totals[i] += durations.get(test, default)
+    return buckets, totals
+
+
+@defer.inlineCallbacks
+def _durations_state(master, service):
+    objectid = yield master.db.state.getObjectId(service, 'ShardedTests')
+    durations = yield master.db.state.getState(objectid, 'durations', {})
+    return objectid, durations
+
+
+class ShardedTests(steps.Trigger):
+    """
+    Runs the tests listed in the `test_list` property as up to `shards`
+    builds of the shard scheduler's builder, balanced by the per-test
+    durations the shards recorded before. Tests that already passed for
+    this `tree_hash` are not run again, so a rebuild after a failure only
+    re-runs what failed. The outcome is the worst of the shards' results.
+    """
+
+    def __init__(self, service, scheduler, shards, cache, **kwargs):
+        self.service = service
+        self.shards = shards
+        self.cache = cache
+        kwargs.setdefault('waitForFinish', True)
+        kwargs.setdefault('updateSourceStamp', True)
+        kwargs.setdefault('parent_relationship', 'Shard of')
+        super().__init__(schedulerNames=[scheduler], **kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        if not self.getProperty('test_list'):
+            yield self.addCompleteLog('shards', 'no tests listed by `make test-list`\n')
+            return FAILURE
+        results = yield super().run()
+        return results
+
+    @defer.inlineCallbacks
+    def getSchedulersAndProperties(self):
+        tree_hash = self.getProperty('tree_hash')
+        passed = self.cache.lookup(_passed_key(tree_hash, self.service)) if tree_hash else None
+        passed = set(passed['tests']) if passed else set()
+        tests = [t for t in self.getProperty('test_list') if t not in passed]
+
+        _, durations = yield _durations_state(self.master, self.service)
+        shards, totals = split_shards(tests, durations, self.shards)
+        yield self.addCompleteLog('shards', ''.join(
+            'shard {}: ~{:.0f}s {}\n'.format(i + 1, total, ' '.join(shard))
+            for i, (shard, total) in enumerate(zip(shards, totals))) +
+            '{} tests already passed for this tree\n'.format(len(passed)))
+        return [{
+            'sched_name': self.schedulerNames[0],
+            'props_to_set': dict(self.set_properties, shard_tests=shard,
+                                 test_shard='{}/{}'.format(i + 1, len(shards))),
+            'unimportant': False,
+        } for i, shard in enumerate(shards)]
+
+
+class RunTestShard(buildstep.ShellMixin, buildstep.BuildStep):
+    """
+    Runs each test in the `shard_tests` property with the step's command
+    plus TESTS=<test>, records each test's duration for ShardedTests and
+    adds the passing tests to this `tree_hash`'s entry in the cache.
+    """
+
+    def __init__(self, service, cache, **kwargs):
+        self.service = service
+        self.cache = cache
+        kwargs = self.setupShellMixin(kwargs)
+        super().__init__(**kwargs)
+
+    @defer.inlineCallbacks
+    def run(self):
+        tests = self.getProperty('shard_tests', [])
+        script = (
+            'rc=0; for t in {tests}; do s=$(date +%s%N); {command} TESTS="$t"; r=$?; '
+            '[ $r -eq 0 ] || rc=1; echo "##test $t $r $(( ($(date +%s%N) - s) / 1000000 ))"; '
+            'done; exit $rc').format(
+                tests=' '.join(shlex.quote(t) for t in tests),
+                command=' '.join(shlex.quote(c) for c in self.command))
+        cmd = yield self.makeRemoteShellCommand(command=['sh', '-c', script], collectStdout=True)
+        yield self.runCommand(cmd)
+
+        timings = {}
+        for line in cmd.stdout.splitlines():
+            fields = line.split()
+            if len(fields) == 4 and fields[0] == '##test':
+                timings[fields[1]] = (int(fields[2]), int(fields[3]) / 1000.0)
+
+        yield self._record(timings)
+        failed = sorted(t for t, (rc, _) in timings.items() if rc != 0)
+        self.descriptionDone = '{} tests, {} failed'.format(len(timings), len(failed))
+        if failed:
+            yield self.addCompleteLog('failed tests', '\n'.join(failed) + '\n')
+        return cmd.results() if not failed else FAILURE
+
+    @defer.inlineCallbacks
+    def _record(self, timings):
+        yield _durations_lock.acquire()
+        try:
+            objectid, durations = yield _durations_state(self.master, self.service)
+            for test, (_, seconds) in timings.items():
+                previous = durations.get(test, seconds)
+                durations[test] = round(
+                    DURATION_SMOOTHING * seconds + (1 - DURATION_SMOOTHING) * previous, 3)
+            yield self.master.db.state.setState(objectid, 'durations', durations)
+        finally:
+            _durations_lock.release()
+
+        tree_hash = self.getProperty('tree_hash')
+        if not tree_hash:
+            return
+        url = yield self.build.getUrl()
+        key = _passed_key(tree_hash, self.service)
+        entry = self.cache.lookup(key)
+        tests = set(entry['tests']) if entry else set()
+        tests.update(t for t, (rc, _) in timings.items() if rc == 0)
+        self.cache.store(key, {
+            'results': SUCCESS,
+            'outputs': [],
+            'tests': sorted(tests),
+            'builder': self.build.builder.name,
+            'number': self.build.number,
+            'url': url,
+            'created': time.time(),
+        })
@@ -1,23 +1,52 @@
 import os
+
+import sqlalchemy as sa
+from twisted.internet import defer
 from buildbot.plugins import util, steps, schedulers
+from buildbot.process.results import SUCCESS
 
 import helpers
 import gitpoller
-
-config = helpers.load_yaml('services_config.yaml')
+import gitmirror
+import workspace
+import buildcache
+import imagededupe
+import parallel
+import shardtests
+import buildqueue
+import routing
+import serviceconfig
+import metrics
+import dbmaintenance
+import kubedeploy
+import manifest
+import logpipeline
+import pipelines
+
+config = helpers.load_yaml('services_config.yaml', __name__)
+serviceconfig.validate_services(config, 'services_config.yaml')
 
 # Increment this if you wipe the DB to prevent reusing build version numbers.
 DATABASE_VERSION = 1
 
 SOURCE_GIT_URL = 'https://github.com'
-POLL_INTERVAL_SECONDS = 600
+# Pushes are picked up by the GitHub hook (githubhook.py); polling only
+# reconciles anything a missed webhook delivery left behind.
+POLL_INTERVAL_SECONDS = 6 * 3600
 
 # Deploy any branches that have any associated realm
 BRANCH_TO_REALM_MAPPING = config['branch_to_realm_mapping']
 DEPLOY_BRANCHES = list(BRANCH_TO_REALM_MAPPING)
 
-# The Docker Hub registry doesn't need a hostname
-REGISTRY = 'klaital'
+# Where images are pushed. The Docker Hub registry doesn't need a hostname.
+REGISTRY = config.get('image_registry', 'klaital')
+
+# Services build their image from this Dockerfile at the top of their tree,
+# unless their `dockerfile` is null, which leaves it to `make push`
+DEFAULT_DOCKERFILE = 'Dockerfile'
+
+# The local registry stand-in the image-dedupe-check builder pushes to
+IMAGE_CHECK_REGISTRY = config.get('image_check_registry', 'localhost:5000')
 
 # List of workers that can concurrently build
 WORKERNAMES = [
@@ -26,132 +55,499 @@ WORKERNAMES = [
 
 SERVICES = config['services']
 
+# Build each service once per revision in a shared `<service>_build` builder
+# and fan out to the `<service>_<realm>` builders only for the deploy stage.
+COALESCE_REALM_BUILDS = config.get('coalesce_realm_builds', False)
+
+# Capacity of each worker and cost of each service's builds, in the units of
+# helpers.WORKER_RESOURCES
+WORKER_CAPACITY = config['worker_capacity']
+DEFAULT_BUILD_RESOURCES = config['default_build_resources']
+
+# Orders the queue: prod ahead of test, long waits and short builds first.
+# Hook PRIORITIZER.prioritizeBuilders into c['prioritizeBuilders'].
+PRIORITIZER = buildqueue.BuildPrioritizer(
+    config.get('realm_head_start_seconds', buildqueue.DEFAULT_REALM_HEAD_START),
+    BRANCH_TO_REALM_MAPPING)
+
+# Where the realms' namespaces live, and the URL each service answers its
+# liveness probe on, with {service} and {realm} filled in
+KUBECONFIG = config['kubernetes']['kubeconfig']
+LIVENESS_URL = config['kubernetes'].get('liveness_url')
+
+# Results of compile/test runs, keyed by git tree hash
+BUILD_CACHE = buildcache.LocalBuildCache(**config.get('build_cache', {}))
+
 for ms in SERVICES:
     SERVICES[ms]['poll_branches'] = DEPLOY_BRANCHES
+    SERVICES[ms]['resources'] = dict(DEFAULT_BUILD_RESOURCES, **SERVICES[ms].get('resources', {}))
+    # a build must fit on the smallest worker, or it would never start
+    for resource in helpers.WORKER_RESOURCES:
+        SERVICES[ms]['resources'][resource] = min(
+            [SERVICES[ms]['resources'][resource]] +
+            [WORKER_CAPACITY[w][resource] for w in WORKERNAMES if w in WORKER_CAPACITY])
+
+# Workers without a declared capacity fit any one build, and run one at a time
+RESOURCE_CAPACITY = {
+    resource: max(SERVICES[ms]['resources'][resource] for ms in SERVICES)
+    for resource in helpers.WORKER_RESOURCES}
+RESOURCE_LOCKS = helpers.make_resource_locks(WORKER_CAPACITY, RESOURCE_CAPACITY)
+
+# Each service's objects survive reconfigs that leave its config unchanged
+SERVICE_OBJECTS = serviceconfig.registry(__name__)
+POLLER_OBJECTS = serviceconfig.registry(__name__ + '.pollers')
+# The sections of the config the services' factories and builders are made
+# from; editing any other section leaves the services as they are
+SHARED_CONFIG_KEYS = ('branch_to_realm_mapping', 'build_cache', 'coalesce_realm_builds',
+                      'default_build_resources', 'image_registry', 'kubernetes',
+                      'realm_head_start_seconds', 'worker_capacity')
+SHARED_CONFIG = {key: config.get(key) for key in SHARED_CONFIG_KEYS}
 
 
 def _is_deploy_branch(step):
     return step.getProperty('branch') in DEPLOY_BRANCHES or step.getProperty('branch') == ""
 
-def _make_factory(name, ms):
-    f = util.BuildFactory()
-
+@defer.inlineCallbacks
+def _same_revision(master, builder, br1, br2):
+    """
+    collapseRequests for the shared builders: requests for the same
+    revision of the same repository are one build, whatever their branch.
+    The collapsed request's branch is deployed by _RealmTrigger.
+    """
+    if br1['buildsetid'] == br2['buildsetid']:
+        return True
+    bs1 = yield master.data.get(('buildsets', str(br1['buildsetid'])))
+    bs2 = yield master.data.get(('buildsets', str(br2['buildsetid'])))
+    sources1 = {ss['codebase']: ss for ss in bs1['sourcestamps']}
+    sources2 = {ss['codebase']: ss for ss in bs2['sourcestamps']}
+    if set(sources1) != set(sources2):
+        return False
+    for codebase, ss1 in sources1.items():
+        ss2 = sources2[codebase]
+        if ss1['patch'] or ss2['patch'] or not ss1['revision']:
+            return False
+        if any(ss1[k] != ss2[k] for k in ('repository', 'project', 'revision')):
+            return False
+    return True
+
+def _thd_branch_heads(conn, model, repository, branches):
+    """branch -> the revision of the newest change on it, for `repository`."""
+    changes = model.changes
+    heads = {}
+    for branch in branches:
+        heads[branch] = conn.scalar(
+            sa.select([changes.c.revision])
+            .where((changes.c.repository == repository) & (changes.c.branch == branch))
+            .order_by(sa.desc(changes.c.changeid)).limit(1))
+    return heads
+
+def _thd_deploy_requested(conn, m, buildername, revision, since):
+    """
+    Whether `buildername` got a request for `revision` at or after `since`
+    that has not failed: it is queued, running or succeeded.
+    """
+    return conn.scalar(
+        sa.select([sa.func.count()])
+        .select_from(m.buildrequests
+                     .join(m.builders, m.buildrequests.c.builderid == m.builders.c.id)
+                     .join(m.buildset_sourcestamps,
+                           m.buildrequests.c.buildsetid == m.buildset_sourcestamps.c.buildsetid)
+                     .join(m.sourcestamps,
+                           m.buildset_sourcestamps.c.sourcestampid == m.sourcestamps.c.id))
+        .where((m.builders.c.name == buildername) &
+               (m.sourcestamps.c.revision == revision) &
+               (m.buildrequests.c.submitted_at >= since) &
+               ((m.buildrequests.c.complete == 0) | (m.buildrequests.c.results == SUCCESS)))) > 0
+
+class _RealmTrigger(steps.Trigger):
+    """
+    Triggers the deploy scheduler of every realm whose deploy branch is at
+    the built revision, which includes the branches of requests collapsed
+    into this build. A realm already given a deploy of the revision since
+    this build was requested is left alone.
+    """
+
+    def __init__(self, service, repository, realm_schedulers, **kwargs):
+        self.service = service
+        self.repository = repository
+        self.realm_schedulers = realm_schedulers
+        super().__init__(schedulerNames=sorted(realm_schedulers.values()), **kwargs)
+
+    @defer.inlineCallbacks
+    def getSchedulersAndProperties(self):
+        revision = self.getProperty('got_revision')
+        pool, model = self.master.db.pool, self.master.db.model
+        heads = yield pool.do(_thd_branch_heads, model, self.repository, DEPLOY_BRANCHES)
+        branches = {b for b, head in heads.items() if revision and head == revision}
+        branches.add(self.getProperty('branch'))
+        since = min(req.submittedAt for req in self.build.requests)
+
+        triggers = []
+        for branch in sorted(b for b in branches if b in BRANCH_TO_REALM_MAPPING):
+            realm = BRANCH_TO_REALM_MAPPING[branch]
+            if realm not in self.realm_schedulers:
+                continue
+            requested = yield pool.do(
+                _thd_deploy_requested, model, f"{self.service}_{realm}", revision, since)
+            if requested:
+                continue
+            triggers.append({
+                'sched_name': self.realm_schedulers[realm],
+                'props_to_set': dict(self.set_properties, deploy_branch=branch),
+                'unimportant': False})
+        return triggers
+
+def _add_compile_steps(f, name, ms, locks=()):
+    """Sync and compile the service; returns the arguments later make calls need."""
     # Sync Git
-    f.addStep(steps.Git(
+    f.addStep(workspace.WarmGit(
         repourl=ms['giturl'],
-        method='clobber',
-        mode='full',
-        shallow=False,
+        reference=gitmirror.reference_for(ms['giturl']),
         haltOnFailure=True,
         name='git sync'))
 
-    # TODO: login to dockerhub
-
-    f.addStep(steps.SetPropertyFromCommand(
-        name="set property from make version",
-        command=["make", "version", "--always-make"],
-        property="project_version",
+    # Tree hash, version and container coordinates, once per revision
+    f.addStep(manifest.BuildManifest(
+        name, BUILD_CACHE, REGISTRY, DATABASE_VERSION, realms=BRANCH_TO_REALM_MAPPING,
         haltOnFailure=True))
 
+    # TODO: login to dockerhub
 
-    version_specific_str = '%(prop:project_version)s-$(prop:branch)s-%(prop:buildnumber)s-' + str(DATABASE_VERSION)
-    version_specifier = util.Interpolate('VERSION=' + version_specific_str)
-    commit_hash_specifier = util.Interpolate('COMMIT_HASH=' + '%(prop:got_revision)s')
-
-    # Compile
-    f.addStep(steps.ShellCommand(
-        name="compile",
-        command=["make", "build", version_specifier, commit_hash_specifier],
-        haltOnFailure=True,
-    ))
+    # The artifacts are stamped with what every build of the revision shares;
+    # the build number only goes into the image tag (see _add_build_steps)
+    version_specifier = util.Interpolate('VERSION=%(prop:artifact_version)s')
+    commit_hash_specifier = util.Interpolate('COMMIT_HASH=%(prop:got_revision)s')
+
+    # Compile. Only services that list their build_outputs can have the
+    # compile restored from the cache; `make push` needs the artifacts.
+    # The key includes the stamps they carry.
+    if ms.get('build_outputs'):
+        f.addStep(buildcache.CachedShellCommand(
+            BUILD_CACHE, "build",
+            outputs=ms['build_outputs'],
+            key_properties=['artifact_version', 'got_revision'],
+            name="compile",
+            command=["make", "build", version_specifier, commit_hash_specifier],
+            haltOnFailure=True,
+            locks=list(locks),
+        ))
+    else:
+        f.addStep(steps.ShellCommand(
+            name="compile",
+            command=["make", "build", version_specifier, commit_hash_specifier],
+            haltOnFailure=True,
+            locks=list(locks),
+        ))
 
-    # Run tests
-    f.addStep(steps.ShellCommand(
+    return [version_specifier, commit_hash_specifier]
+
+def _make_test_step(name, ms, make_args):
+    if ms.get('test_shards', 1) > 1:
+        return shardtests.ShardedTests(
+            name, f"test-shards-{name}", ms['test_shards'], BUILD_CACHE,
+            name="run tests",
+            warnOnFailure=not ms['fail_on_tests'],
+            haltOnFailure=ms['fail_on_tests'],
+            doStepIf=ms['run_tests'],
+        )
+    return buildcache.CachedShellCommand(
+        BUILD_CACHE, "test",
         name="run tests",
-        command=["make", "test", version_specifier, commit_hash_specifier],
+        command=["make", "test"] + make_args,
         warnOnFailure=not ms['fail_on_tests'],
         haltOnFailure=ms['fail_on_tests'],
         doStepIf=ms['run_tests'],
-    ))
+    )
 
-    # Build image and push to Docker registry
-    f.addStep(steps.ShellCommand(
-        name="push docker image to registry",
-        haltOnFailure=True,
-        command=["make", "push", version_specifier, commit_hash_specifier],
-        doStepIf=_is_deploy_branch,
-        ))
+def _make_factory(name, ms):
+    return pipelines.shared_factory(
+        ['build', name, ms, SHARED_CONFIG, RESOURCE_CAPACITY],
+        lambda f: _add_build_steps(f, name, ms))
+
+def _add_build_steps(f, name, ms):
+    # The worker's resources are held by the steps that use them, not the
+    # build, so a build waiting on its deploy or rollout holds none
+    locks = helpers.resource_lock_accesses(RESOURCE_LOCKS, ms['resources'])
 
     f.addStep(steps.SetProperties(
-        name="set container properties",
+        name="build timing",
         properties={
-            'container_name': REGISTRY + r'\/' + name,
-            'container_tag': util.Interpolate(version_specific_str),
-            'project_name': name,
-        }
-    ))
+            'commit_to_build_seconds': helpers._get_commit_latency,
+            'queue_wait_seconds': helpers._get_queue_wait,
+        },
+        hideStepIf=True))
+
+    make_args = _add_compile_steps(f, name, ms, locks)
+    # the image, unlike the artifacts, is tagged per build
+    push_args = [util.Interpolate('VERSION=%(prop:build_version)s')] + make_args[1:]
+    dockerfile = ms.get('dockerfile', DEFAULT_DOCKERFILE)
+    if dockerfile:
+        image_build = dict(context='.', dockerfile=dockerfile, build_args={
+            'VERSION': util.Interpolate('%(prop:build_version)s'),
+            'COMMIT_HASH': util.Interpolate('%(prop:got_revision)s')})
+    else:
+        image_build = dict(command=["make", "push"] + push_args, env=dict(imagededupe.DOCKER_ENV))
+
+    # Sharded tests run in builds of their own, which take the resources
+    # themselves; the step waiting for them must not hold any
+    sharded = ms.get('test_shards', 1) > 1
+    if sharded:
+        f.addStep(steps.SetPropertyFromCommand(
+            name="list tests",
+            command=["make", "test-list"],
+            extract_fn=lambda rc, stdout, stderr: {'test_list': stdout.split()},
+            haltOnFailure=True,
+            doStepIf=ms['run_tests'],
+            locks=locks,
+        ))
 
-    # TODO: add actual k8s deployment step
+    # Run tests while the image is built and pushed; both only need the
+    # compiled tree, and a failed test run still halts before deploying
+    f.addStep(parallel.ParallelGroup(name="test and push", steps=[
+        _make_test_step(name, ms, make_args),
+
+        # Build image and push to Docker registry, or retag the image
+        # already pushed for this tree
+        imagededupe.DedupedImagePush(
+            target=REGISTRY + '/' + name,
+            image=util.Interpolate(REGISTRY + '/' + name + ':%(prop:container_tag)s'),
+            name="push docker image to registry",
+            haltOnFailure=True,
+            doStepIf=_is_deploy_branch,
+            locks=locks if sharded else [],
+            **image_build
+        ),
+    ], locks=[] if sharded else locks))
+
+    # The deploy builds report their own results; the shared build does not
+    # wait for them, so the next build of the service can start meanwhile
+    if COALESCE_REALM_BUILDS:
+        f.addStep(_RealmTrigger(
+            name, ms['giturl'],
+            name="deploy to realm",
+            realm_schedulers={BRANCH_TO_REALM_MAPPING[branch]:
+                              f"deploy-{name}-{BRANCH_TO_REALM_MAPPING[branch]}"
+                              for branch in get_all_possible_branch_names()},
+            waitForFinish=False,
+            copy_properties=['container_name', 'container_tag', 'project_name',
+                             'project_version', 'build_version', 'tree_hash'],
+            parent_relationship="Deployed from",
+            doStepIf=_is_deploy_branch,
+        ))
+    else:
+        _add_deploy_steps(f, name, doStepIf=_is_deploy_branch)
+
+def _add_deploy_steps(f, name, **kwargs):
+    # Helm upgrade into the namespace of the `realm` property, then wait
+    # for the rollout and the liveness probe
+    liveness_url = None
+    if LIVENESS_URL:
+        liveness_url = util.Interpolate(LIVENESS_URL.format(service=name, realm='%(prop:realm)s'))
+    f.addStep(kubedeploy.KubeRollout(
+        name="deploy to realm",
+        realm=util.Property('realm'),
+        kubeconfig=KUBECONFIG,
+        namespace=util.Property('realm'),
+        resources=['deployment/' + name],
+        liveness_url=liveness_url,
+        command=helpers._get_helm_command,
+        haltOnFailure=True,
+        **kwargs))
+
+def _make_deploy_factory(name):
+    """
+    The per-realm stage of a coalesced build; it runs from _RealmTrigger.
+    All realms share it, each builder sets its `realm` property.
+    """
+    return pipelines.shared_factory(
+        ['deploy', name, SHARED_CONFIG], lambda f: _add_deploy_steps(f, name))
+
+def _make_shard_factory(name, ms):
+    """Runs one shard of a ShardedTests step on any worker."""
+    def add_steps(f):
+        make_args = _add_compile_steps(f, name, ms)
+        f.addStep(shardtests.RunTestShard(
+            name, BUILD_CACHE,
+            name="run test shard",
+            command=["make", "test"] + make_args,
+            haltOnFailure=True,
+        ))
+    return pipelines.shared_factory(['test-shard', name, ms, SHARED_CONFIG], add_steps)
+
+def _make_service_objects(s_name):
+    s = SERVICES[s_name]
+    objects = {'builders': [], 'schedulers': []}
+
+    b = objects['builders']
+    factory = _make_factory(s_name, s)
+    locks = helpers.resource_lock_accesses(RESOURCE_LOCKS, s['resources'])
+    if COALESCE_REALM_BUILDS:
+        # one shared build per service at a time, so that a revision
+        # reaching several branches finds the previous build in the caches;
+        # queued requests for the same revision are built once
+        service_lock = util.MasterLock(f"{s_name}_shared_build")
+        b.append(util.BuilderConfig(name=_shared_buildername(s_name, None),
+            workernames=WORKERNAMES,
+            factory=factory,
+            locks=[service_lock.access('exclusive')],
+            collapseRequests=_same_revision,
+            nextBuild=PRIORITIZER.nextBuild,
+            description="Builds, tests and pushes each revision once, then triggers "
+                        "the deploy builds of the realms at that revision. Its result "
+                        "does not include theirs; see the <service>_<realm> builders.",
+            tags=[s_name, 'build']))
+
+    if s.get('test_shards', 1) > 1:
+        # every shard is a separate request for the same revision, so
+        # they must not be collapsed into one build
+        b.append(util.BuilderConfig(name=f"{s_name}_test_shard",
+            workernames=WORKERNAMES,
+            factory=_make_shard_factory(s_name, s),
+            locks=locks,
+            collapseRequests=False,
+            nextBuild=PRIORITIZER.nextBuild,
+            tags=[s_name, 'test-shard']))
+        objects['schedulers'].append(
+            schedulers.Triggerable(
+                name=f"test-shards-{s_name}",
+                builderNames=[f"{s_name}_test_shard"],
+            )
+        )
+
+    for branch in get_all_possible_branch_names():
+        realm = BRANCH_TO_REALM_MAPPING[branch]
+        if COALESCE_REALM_BUILDS:
+            b.append(util.BuilderConfig(name=f"{s_name}_{realm}",
+                workernames=WORKERNAMES,
+                factory=_make_deploy_factory(s_name),
+                properties={'realm': realm},
+                nextBuild=PRIORITIZER.nextBuild,
+                tags=[s_name, realm]))
+            objects['schedulers'].append(
+                schedulers.Triggerable(
+                    name=f"deploy-{s_name}-{realm}",
+                    builderNames=[f"{s_name}_{realm}"],
+                )
+            )
+        else:
+            b.append(util.BuilderConfig(name=f"{s_name}_{realm}",
+                workernames=WORKERNAMES,
+                factory=factory,
+                nextBuild=PRIORITIZER.nextBuild,
+                tags=[s_name, realm]))
 
-    # TODO: add liveness check step
+        objects['schedulers'].append(
+            schedulers.ForceScheduler(
+                name=f"force-{s_name}-{realm}",
+                codebases=[
+                    util.CodebaseParameter(
+                        "",
+                        label="Repository",
+                        branch=util.FixedParameter(name="branch", default=branch),
+                        revision=util.StringParameter(name="revision", default=""),
+                        repository=util.FixedParameter(name="repository", default=s['giturl']),
+                        project=util.FixedParameter(name="project", default=s_name),
+                    )
+                ],
+                builderNames=[_shared_buildername(s_name, realm)],
+            )
+        )
 
-    return f
+    return objects
 
-def add_all_changesources(cfg):
+def _service_objects(s_name):
+    # rebuilt only when the service's entry, the shared sections of the
+    # config or the resource locks it uses changed since the last reconfig
+    return SERVICE_OBJECTS.get(
+        s_name, [SERVICES[s_name], SHARED_CONFIG, RESOURCE_CAPACITY],
+        lambda: _make_service_objects(s_name))
+
+def _repositories():
+    """giturl -> names of the services built from it; a monorepo has several."""
+    repos = {}
     for s_name in SERVICES:
-        s = SERVICES[s_name]
-        gp = gitpoller.KGitPoller(
-                repourl=s['giturl'],
-                branches=True,
-                buildPushesWithNoCommits=True,
-                pollInterval=POLL_INTERVAL_SECONDS,
-                pollAtLaunch=True,
-                workdir="/tmp/gitpoller-workdir-"+s_name,
-                project=s_name)
-        cfg['change_source'].append(gp)
+        repos.setdefault(SERVICES[s_name]['giturl'], []).append(s_name)
+    return repos
+
+def _repository_name(giturl):
+    name = giturl.rstrip('/').rsplit('/', 1)[-1]
+    return name[:-len('.git')] if name.endswith('.git') else name
+
+def _make_poller(giturl, s_names):
+    # a repository of one service keeps that service's name as its project
+    project = s_names[0] if len(s_names) == 1 else _repository_name(giturl)
+    return {'change_source': [gitpoller.KGitPoller(
+            repourl=giturl,
+            branches=True,
+            buildPushesWithNoCommits=True,
+            pollInterval=POLL_INTERVAL_SECONDS,
+            pollAtLaunch=True,
+            project=project)]}
 
+def add_all_changesources(cfg):
+    # one poller per repository, however many services it holds
+    for giturl, s_names in _repositories().items():
+        cfg['change_source'].extend(POLLER_OBJECTS.get(
+            giturl, [s_names, POLL_INTERVAL_SECONDS],
+            lambda: _make_poller(giturl, s_names))['change_source'])
+
+
+def add_all_services(cfg):
+    cfg['services'].append(gitmirror.MirrorJanitor(
+        repourls=[SERVICES[s_name]['giturl'] for s_name in SERVICES]))
+    cfg['services'].append(metrics.MetricsService(
+        realms=sorted(set(BRANCH_TO_REALM_MAPPING.values())),
+        port=config.get('metrics_port', metrics.METRICS_PORT)))
+    cfg['services'].append(dbmaintenance.StateMaintenance(
+        retention=config.get('state_retention', {}),
+        pool_threads=config.get('sqlite_pool_threads')))
+    cfg['services'].append(logpipeline.LogBatching(**config.get('log_batching', {})))
+
+
+def _shared_buildername(s_name, realm):
+    if COALESCE_REALM_BUILDS:
+        return f"{s_name}_build"
+    return f"{s_name}_{realm}"
+
+def _make_image_check_objects():
+    """A forced builder that checks the image dedupe against a local registry."""
+    f = util.BuildFactory()
+    imagededupe.add_check_steps(f, IMAGE_CHECK_REGISTRY)
+    return {
+        'builders': [util.BuilderConfig(name="image-dedupe-check",
+            workernames=WORKERNAMES,
+            factory=f,
+            tags=['check'])],
+        'schedulers': [schedulers.ForceScheduler(
+            name="force-image-dedupe-check",
+            builderNames=["image-dedupe-check"])],
+    }
+
+# The image-dedupe-check objects survive reconfigs that keep its registry
+CHECK_OBJECTS = serviceconfig.registry(__name__ + '.checks')
+
+def _image_check_objects():
+    return CHECK_OBJECTS.get(
+        'image-dedupe-check', [IMAGE_CHECK_REGISTRY, WORKERNAMES], _make_image_check_objects)
 
 def add_all_builders(b):
     for s_name in SERVICES:
-        factory = _make_factory(s_name, SERVICES[s_name])
-        for branch in get_all_possible_branch_names():
-            realm = branch[len('deploy-'):]
-            b.append(util.BuilderConfig(name=f"{s_name}_{realm}",
-                workernames=WORKERNAMES,
-                factory=factory,
-                locks=[helpers.WORKER_LOCK.access('exclusive')],
-                tags=[s_name, realm]))
+        b.extend(_service_objects(s_name)['builders'])
+    b.extend(_image_check_objects()['builders'])
 
 def add_all_schedulers(cfg):
+    routes = {}
     for s_name in SERVICES:
+        cfg['schedulers'].extend(_service_objects(s_name)['schedulers'])
+        rule = routing.PathRule(SERVICES[s_name].get('paths'), SERVICES[s_name].get('ignore_paths'))
         for branch in get_all_possible_branch_names():
-            realm = BRANCH_TO_REALM_MAPPING[branch]
-            buildername = f"{s_name}_{realm}"
-            cfg['schedulers'].append(
-                schedulers.ForceScheduler(
-                    name=f"force-{s_name}-{realm}",
-                    codebases=[
-                        util.CodebaseParameter(
-                            "",
-                            label="Repository",
-                            branch=util.FixedParameter(name="branch", default=branch),
-                            revision=util.StringParameter(name="revision", default=""),
-                            repository=util.FixedParameter(name="repository", default=SERVICES[s_name]['giturl']),
-                            project=util.FixedParameter(name="project", default=s_name),
-                        )
-                    ],
-                    builderNames=[buildername],
-                )
-            )
-            
-            cfg['schedulers'].append(
-                schedulers.SingleBranchScheduler(
-                    name=f"commit-{s_name}-{realm}",
-                    builderNames=[buildername],
-                    treeStableTimer=0,
-                    change_filter=util.ChangeFilter(branch=branch, project=s_name),
-                )
-            )
+            buildername = _shared_buildername(s_name, BRANCH_TO_REALM_MAPPING[branch])
+            routes.setdefault((SERVICES[s_name]['giturl'], branch), []).append((rule, [buildername]))
+
+    # every commit to a deploy branch builds the services whose paths it
+    # touches, for the branch's realm
+    cfg['schedulers'].append(routing.RoutingScheduler(name="commit-router", routes=routes))
+    cfg['schedulers'].extend(_image_check_objects()['schedulers'])
 
 
 def get_all_possible_branch_names():
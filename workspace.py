@@ -0,0 +1,67 @@
+from twisted.internet import defer
+from buildbot.steps.source.git import Git
+
+RC_SUCCESS = 0
+
+
+class WarmGit(Git):
+    """
+    A Git step that keeps the builder's checkout between builds: it fetches
+    and resets the existing checkout and removes every untracked and ignored
+    file (mode 'full', method 'fresh'). The result is then verified by
+    rehashing the working tree against HEAD, and only a checkout that fails
+    verification is clobbered and cloned again.
+
+    Sets `sync_seconds`, and `sync_seconds_saved` relative to the last clobber
+    of this builder's workspace, whose duration is kept in the master's state.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs['mode'] = 'full'
+        kwargs['method'] = 'fresh'
+        kwargs.setdefault('clobberOnFailure', True)
+        super().__init__(**kwargs)
+
+    @defer.inlineCallbacks
+    def _isCleanCheckout(self):
+        # rehash every file, then compare working tree -> index -> HEAD tree
+        yield self._dovccmd(['update-index', '-q', '--really-refresh'], abandonOnFailure=False)
+        rc = yield self._dovccmd(['diff-files', '--quiet'], abandonOnFailure=False)
+        if rc != RC_SUCCESS:
+            return False
+        rc = yield self._dovccmd(['diff-index', '--cached', '--quiet', 'HEAD'],
+                                 abandonOnFailure=False)
+        if rc != RC_SUCCESS:
+            return False
+        others = yield self._dovccmd(['ls-files', '--others'], abandonOnFailure=False,
+                                     collectStdout=True)
+        return isinstance(others, str) and not others.strip()
+
+    @defer.inlineCallbacks
+    def fresh(self):
+        yield super().fresh()
+        clean = yield self._isCleanCheckout()
+        if clean:
+            self._warm = True
+            return
+        yield self.stdio_log.addHeader('workspace failed verification, clobbering\n')
+        yield self.clobber()
+
+    @defer.inlineCallbacks
+    def run_vc(self, branch, revision, patch):
+        self._warm = False
+        started = self.master.reactor.seconds()
+        res = yield super().run_vc(branch, revision, patch)
+        elapsed = self.master.reactor.seconds() - started
+
+        state = self.master.db.state
+        objectid = yield state.getObjectId(self.build.builder.name, 'WarmGit')
+        self.setProperty('sync_seconds', round(elapsed, 1), 'WarmGit')
+        if self._warm:
+            clobber_seconds = yield state.getState(objectid, 'clobber_seconds', None)
+            if clobber_seconds is not None:
+                self.setProperty('sync_seconds_saved', round(clobber_seconds - elapsed, 1),
+                                 'WarmGit')
+        else:
+            yield state.setState(objectid, 'clobber_seconds', elapsed)
+        return res